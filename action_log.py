@@ -2,10 +2,47 @@
 from __future__ import annotations
 
 import datetime as dt
-from collections import defaultdict, deque
-from typing import Deque, Dict, List
+import time
+from typing import Dict, List
 
-_ACTIONS: Dict[int, Deque[dict]] = defaultdict(lambda: deque(maxlen=50))
+_MAX_ACTIONS_PER_USER = 50
+
+_NOW_TTL_SECONDS = 30.0
+_now_cache: List = [float("-inf"), ""]
+
+
+class _UserActions:
+    """Fixed-size ring buffer of one user's actions.
+
+    Each slot holds the summary line without its ordinal number, formatted once at write time.
+    """
+
+    __slots__ = ("entries", "head", "size")
+
+    def __init__(self, capacity: int = _MAX_ACTIONS_PER_USER) -> None:
+        self.entries: List[str] = [""] * capacity
+        self.head = 0  # index of the next slot to write
+        self.size = 0
+
+    def append(self, entry: str) -> None:
+        capacity = len(self.entries)
+        self.entries[self.head] = entry
+        self.head = (self.head + 1) % capacity
+        if self.size < capacity:
+            self.size += 1
+
+
+_ACTIONS: Dict[int, _UserActions] = {}
+_VERSIONS: Dict[int, int] = {}
+
+
+def _now_str() -> str:
+    """Return the current local time with minute resolution, refreshed at most every 30 seconds."""
+    now = time.monotonic()
+    if now - _now_cache[0] > _NOW_TTL_SECONDS:
+        _now_cache[0] = now
+        _now_cache[1] = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
+    return _now_cache[1]
 
 
 def log_action(user_id: int, action_type: str, payload: dict) -> None:
@@ -14,21 +51,31 @@ def log_action(user_id: int, action_type: str, payload: dict) -> None:
         safe_user_id = int(user_id)
     except (TypeError, ValueError):
         return
-    timestamp = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
-    _ACTIONS[safe_user_id].append({"timestamp": timestamp, "action_type": action_type, "payload": payload})
+    payload = payload or {}
+    get = payload.get
+    title = get("title") or get("summary") or get("body")
+    due = get("due_datetime") or get("start_datetime")
+    actions = _ACTIONS.get(safe_user_id)
+    if actions is None:
+        actions = _ACTIONS[safe_user_id] = _UserActions()
+    actions.append(f"{_now_str()} — {action_type} {title or ''} {f'({due})' if due else ''}".strip())
+    _VERSIONS[safe_user_id] = _VERSIONS.get(safe_user_id, 0) + 1
+
+
+def get_actions_version(user_id: int) -> int:
+    """Return a counter that changes whenever an action is logged for the user."""
+    return _VERSIONS.get(user_id, 0)
 
 
 def get_recent_actions_summary(user_id: int, limit: int = 5) -> str:
     """Return a short textual summary of recent actions for prompt context."""
-    actions = list(_ACTIONS.get(user_id, deque()))
-    if limit > 0:
-        actions = actions[-limit:]
-    lines: List[str] = []
-    for idx, item in enumerate(actions, start=1):
-        payload = item.get("payload", {}) or {}
-        title = payload.get("title") or payload.get("summary") or payload.get("body")
-        due = payload.get("due_datetime") or payload.get("start_datetime")
-        lines.append(
-            f"{idx}) {item.get('timestamp')} — {item.get('action_type')} {title or ''} {f'({due})' if due else ''}".strip()
-        )
-    return "\n".join(lines)
+    actions = _ACTIONS.get(user_id)
+    if actions is None or not actions.size:
+        return ""
+    count = min(limit, actions.size) if limit > 0 else actions.size
+    entries = actions.entries
+    capacity = len(entries)
+    first = actions.head - count
+    return "\n".join(
+        f"{number}) {entries[(first + number - 1) % capacity]}" for number in range(1, count + 1)
+    )
@@ -0,0 +1,278 @@
+"""In-memory caches for model responses and classification results."""
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import json
+import math
+import operator
+import re
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib json is used otherwise
+    orjson = None
+
+
+def _dumps_sorted(value: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        except TypeError:  # e.g. keys of mixed types that cannot be sorted; fall back to stdlib json
+            pass
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def make_key(**parts: Any) -> str:
+    """Build a stable cache key from call parameters."""
+    return hashlib.blake2b(_dumps_sorted(parts), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """Bounded LRU cache with per-entry TTL.
+
+    The cache is only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl_seconds: float = 600.0) -> None:
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def snapshot(self) -> list:
+        """Copy of the live entries as [key, wall-clock expiry, value] rows for write_snapshot().
+
+        Must be called on the event loop thread, like every other method; the returned list is
+        independent of the cache and can be written from a worker thread.
+        Expiry is stored as wall-clock time because monotonic time does not survive restarts.
+        """
+        now_monotonic = time.monotonic()
+        now_wall = time.time()
+        return [
+            [key, now_wall + (expires_at - now_monotonic), value]
+            for key, (expires_at, value) in self._data.items()
+            if expires_at > now_monotonic
+        ]
+
+    @staticmethod
+    def write_snapshot(path: Path, entries: list) -> int:
+        """Write rows from snapshot() to a JSON file; returns the number of entries written.
+
+        Values must be JSON-serializable.
+        """
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(entries, ensure_ascii=False), encoding="utf-8")
+        tmp_path.replace(path)
+        return len(entries)
+
+    def dump(self, path: Path) -> int:
+        """Write live entries to a JSON file; returns the number of entries written."""
+        return self.write_snapshot(path, self.snapshot())
+
+    @staticmethod
+    def read_snapshot(path: Path) -> list:
+        """Read rows written by write_snapshot() for restore(); an empty list if the file is missing.
+
+        Touches only the file, so it can run in a worker thread.
+        """
+        if not path.exists():
+            return []
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def restore(self, entries: list) -> int:
+        """Add rows from read_snapshot(), skipping expired ones; returns the number loaded.
+
+        Must be called on the event loop thread, like every other method.
+        """
+        now_monotonic = time.monotonic()
+        now_wall = time.time()
+        loaded = 0
+        for key, expires_wall, value in entries:
+            remaining = expires_wall - now_wall
+            if remaining <= 0:
+                continue
+            self._data[key] = (now_monotonic + min(remaining, self.ttl_seconds), value)
+            loaded += 1
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return loaded
+
+    def load(self, path: Path) -> int:
+        """Load entries written by dump() or write_snapshot(), skipping expired ones; returns the number loaded."""
+        return self.restore(self.read_snapshot(path))
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[Any]") -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution.
+
+    The first caller starts the coroutine as a task; every caller, the first one
+    included, awaits that task. A cancelled caller only stops waiting: the shared
+    call keeps running for the others and is cancelled once nobody waits for it.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[str, _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = self._inflight[key] = _Flight(asyncio.ensure_future(factory()))
+            flight.task.add_done_callback(functools.partial(self._forget, key, flight))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key: str, flight: _Flight, _task: "Optional[asyncio.Task[Any]]" = None) -> None:
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def canonicalize_text(text: str) -> str:
+    """Normalize user text so trivial variations share a cache key."""
+    lowered = text.casefold().replace("ё", "е")
+    lowered = _PUNCTUATION_RE.sub(" ", lowered)
+    return _WHITESPACE_RE.sub(" ", lowered).strip()
+
+
+def _normalize_vector(vector: Sequence[float]) -> Optional["array[float]"]:
+    """Unit-length copy of the vector as packed float32 (4 bytes per component instead of a float object)."""
+    norm = math.sqrt(sum(map(operator.mul, vector, vector)))
+    if not norm:
+        return None
+    return array("f", [x / norm for x in vector])
+
+
+def _quantize_vector(vector: Sequence[float]) -> Optional[Tuple["array[int]", float]]:
+    """Unit-length int8 copy of the vector plus the scale that maps it back (1 byte per component).
+
+    The dot product of the int8 components with a float query, multiplied by the scale,
+    approximates the cosine similarity to within a few thousandths.
+    """
+    unit = _normalize_vector(vector)
+    if unit is None:
+        return None
+    scale = max(map(abs, unit)) / 127
+    return array("b", [round(x / scale) for x in unit]), scale
+
+
+class SemanticCache:
+    """Bounded cache matched by exact canonical text or embedding cosine similarity.
+
+    Entries can be limited to a scope (e.g. a fingerprint of the dialog context):
+    lookups only match entries stored under the same scope. Entries expire after
+    ttl_seconds. hits counts exact and similarity matches; misses counts similarity
+    searches that found nothing. Stored embeddings are quantized to int8.
+    """
+
+    def __init__(self, maxsize: int = 256, threshold: float = 0.92, ttl_seconds: float = 3600.0) -> None:
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Tuple[str, str], Tuple[float, Optional[Tuple[array[int], float]], Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_exact(self, key: str, scope: str = "") -> Optional[Any]:
+        entry = self._data.get((scope, key))
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[(scope, key)]
+            return None
+        self.hits += 1
+        return entry[2]
+
+    def search(self, vector: Sequence[float], scope: str = "") -> Optional[Any]:
+        query = _normalize_vector(vector)
+        if query is None:
+            return None
+        now = time.monotonic()
+        best_score = self.threshold
+        best_value = None
+        expired = []
+        for entry_key, (expires_at, stored, value) in self._data.items():
+            if expires_at < now:
+                expired.append(entry_key)
+                continue
+            if entry_key[0] != scope or stored is None or len(stored[0]) != len(query):
+                continue
+            components, scale = stored
+            score = sum(map(operator.mul, components, query)) * scale
+            if score >= best_score:
+                best_score = score
+                best_value = value
+        for entry_key in expired:
+            del self._data[entry_key]
+        if best_value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best_value
+
+    def add(self, key: str, vector: Optional[Sequence[float]], value: Any, scope: str = "") -> None:
+        if self.maxsize <= 0:
+            return
+        stored = _quantize_vector(vector) if vector else None
+        self._data[(scope, key)] = (time.monotonic() + self.ttl_seconds, stored, value)
+        self._data.move_to_end((scope, key))
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
@@ -2,11 +2,11 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from enum import Enum
+from enum import StrEnum
 from typing import Dict, List, Optional, TypedDict, Any
 
 
-class ActionKind(str, Enum):
+class ActionKind(StrEnum):
     CREATE = "CREATE"
     READ = "READ"
     UPDATE = "UPDATE"
@@ -14,7 +14,7 @@ class ActionKind(str, Enum):
     OTHER = "OTHER"
 
 
-class Topic(str, Enum):
+class Topic(StrEnum):
     PERSONAL_NOTE = "PERSONAL_NOTE"
     PERSONAL_TASK = "PERSONAL_TASK"
     TEAM_TASK = "TEAM_TASK"
@@ -23,7 +23,7 @@ class Topic(str, Enum):
     OTHER = "OTHER"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Classification:
     kind: ActionKind
     topic: Topic
@@ -45,7 +45,44 @@ class ActionParams(TypedDict, total=False):
     clarify_question: str
 
 
-@dataclass
+class IntentResult(TypedDict):
+    topic: str
+    intent: str
+    rough_method: str
+    complexity: str
+    confidence: float
+
+
+class StructuredFields(TypedDict):
+    title: Optional[str]
+    description: Optional[str]
+    due_datetime_local: Optional[str]
+    priority: Optional[str]
+    tags: Optional[List[str]]
+    assignees: Optional[List[str]]
+    summary: Optional[str]
+    start_datetime_local: Optional[str]
+    end_datetime_local: Optional[str]
+    all_day: Optional[bool]
+    body: Optional[str]
+
+
+class PlanResult(TypedDict, total=False):
+    method: str
+    params: Dict[str, Any]
+    user_visible_answer: Optional[str]
+    confidence: float
+    clarify_question: Optional[str]
+    original_question: str
+
+
+class ReviewResult(TypedDict):
+    quality: float
+    problems: List[Any]
+    clarify_question: Optional[str]
+
+
+@dataclass(slots=True)
 class PlannedAction:
     method: str
     confidence: float
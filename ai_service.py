@@ -2,24 +2,457 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import copy
+import functools
+import heapq
 import json
 import logging
-import os
-from typing import Any, Dict, Optional
-
+import random
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.api_core.client_options import ClientOptions
+
+try:
+    import orjson
+except ImportError:  # orjson — необязательное ускорение, работаем и на stdlib json
+    orjson = None
 
-from action_log import get_recent_actions_summary
+from action_log import get_actions_version, get_recent_actions_summary
+from ai_cache import ResponseCache, SemanticCache, SingleFlight, canonicalize_text, make_key
+from ai_schemas import IntentResult, PlanResult, ReviewResult, StructuredFields
 from config import CONFIG
-from dialog_history import get_recent_history
+from dialog_history import get_history_version, get_recent_history
 import debug_service
 import google_service
 
 logger = logging.getLogger(__name__)
 
-api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GENAI_API_KEY")
-if api_key:
-    genai.configure(api_key=api_key)
+# Колбэк потокового ответа: получает весь накопленный к этому моменту текст
+ChunkCallback = Callable[[str], Awaitable[None]]
+
+_models: Dict[tuple[str, int, Optional[str]], Any] = {}
+_key_clients: Dict[int, Any] = {}
+# Ограничение одновременных запросов к модели: при всплеске нагрузки лишние ждут, а не упираются в квоты
+_model_slots: Any = (
+    asyncio.Semaphore(CONFIG.ai_concurrency) if CONFIG.ai_concurrency > 0 else contextlib.nullcontext()
+)
+_model_lock = threading.Lock()
+# Неудачное создание модели повторяется не сразу, а с растущей паузой: (когда повторить, текущая пауза)
+_model_failures: Dict[tuple[str, int, Optional[str]], tuple[float, float]] = {}
+_MODEL_RETRY_BASE_SECONDS = 5.0
+_MODEL_RETRY_CAP_SECONDS = 300.0
+
+
+@functools.lru_cache(maxsize=1)
+def _ensure_configured() -> bool:
+    """Настраивает SDK ключом из конфигурации при первом обращении к модели."""
+
+    if not CONFIG.genai_api_key:
+        raise RuntimeError("Gemini API key is not configured: set GOOGLE_API_KEY or GENAI_API_KEY")
+    genai.configure(api_key=CONFIG.genai_api_key)
+    return True
+
+
+class _ApiKeyPool:
+    """Ротация API-ключей: вызовы распределяются по кругу, ключ с исчерпанной квотой (429) отдыхает.
+
+    Используется только из потока event loop, поэтому блокировки не нужны.
+    """
+
+    __slots__ = ("size", "cooldown_seconds", "usage", "_cooldown_until", "_next")
+
+    def __init__(self, size: int, cooldown_seconds: float) -> None:
+        self.size = max(size, 1)
+        self.cooldown_seconds = cooldown_seconds
+        self.usage = [0] * self.size
+        self._cooldown_until = [0.0] * self.size
+        self._next = 0
+
+    def acquire(self) -> int:
+        """Индекс следующего ключа не на паузе; если на паузе все — того, что освободится раньше."""
+
+        now = time.monotonic()
+        for offset in range(self.size):
+            index = (self._next + offset) % self.size
+            if self._cooldown_until[index] <= now:
+                break
+        else:
+            index = min(range(self.size), key=self._cooldown_until.__getitem__)
+        self._next = (index + 1) % self.size
+        self.usage[index] += 1
+        return index
+
+    def cool_down(self, index: int) -> bool:
+        """Ставит ключ на паузу; возвращает True, если сейчас доступен другой ключ."""
+
+        now = time.monotonic()
+        self._cooldown_until[index] = now + self.cooldown_seconds
+        return any(until <= now for until in self._cooldown_until)
+
+    def disable(self, index: int) -> None:
+        """Навсегда исключает ключ из ротации (ключ по умолчанию не исключается)."""
+
+        if index:
+            self._cooldown_until[index] = float("inf")
+
+
+_api_keys = _ApiKeyPool(len(CONFIG.genai_api_keys), CONFIG.ai_key_cooldown_seconds)
+
+
+def _get_model(
+    model_name: Optional[str] = None, key_index: int = 0, system_instruction: Optional[str] = None
+) -> Any:
+    """Возвращает общий экземпляр модели для (имя, ключ, system instruction), создавая его один раз.
+
+    Ключ по умолчанию (индекс 0) работает через клиент SDK из genai.configure; для остальных
+    ключей пула модели используют общий на ключ клиент с этим ключом (потокобезопасно).
+    Если SDK не даёт подменить клиент модели, ключ исключается из пула и возвращается модель
+    ключа по умолчанию. После ошибки создания возвращает None до конца паузы, которая удваивается
+    до _MODEL_RETRY_CAP_SECONDS, а затем пробует снова.
+    """
+
+    name = model_name or CONFIG.AI_MODEL
+    cache_key = (name, key_index, system_instruction)
+    model = _models.get(cache_key)
+    if model is not None:
+        return model
+    with _model_lock:
+        model = _models.get(cache_key)
+        failure = _model_failures.get(cache_key)
+        if model is None and failure is not None and time.monotonic() < failure[0]:
+            return None
+        if model is None:
+            try:
+                _ensure_configured()
+                model = genai.GenerativeModel(name, system_instruction=system_instruction)
+                if key_index:
+                    # Приватное поле SDK: google-generativeai 0.8.x читает его в generate_content_async,
+                    # поэтому версия закреплена в requirements.txt; без поля запросы ушли бы с общим ключом
+                    if not hasattr(model, "_async_client"):
+                        logger.error(
+                            "google-generativeai не поддерживает клиента на модель, ключ #%s исключён из ротации",
+                            key_index,
+                        )
+                        _api_keys.disable(key_index)
+                        model = None
+                    else:
+                        client = _key_clients.get(key_index)
+                        if client is None:
+                            client = _key_clients[key_index] = glm.GenerativeServiceAsyncClient(
+                                client_options=ClientOptions(api_key=CONFIG.genai_api_keys[key_index])
+                            )
+                        model._async_client = client
+                if model is not None:
+                    _models[cache_key] = model
+                    _model_failures.pop(cache_key, None)
+            except Exception as e:  # noqa: BLE001
+                backoff = min(failure[1] * 2, _MODEL_RETRY_CAP_SECONDS) if failure else _MODEL_RETRY_BASE_SECONDS
+                _model_failures[cache_key] = (time.monotonic() + backoff, backoff)
+                logger.exception("Ошибка инициализации модели, повтор не раньше чем через %.0f с: %s", backoff, e)
+                return None
+    if model is None:
+        # Ключ исключён из ротации: запрос идёт через ключ по умолчанию, а не молча с чужим клиентом
+        return _get_model(name, 0, system_instruction)
+    return model
+
+
+async def warm_up() -> None:
+    """Заранее создаёт модели и открывает соединения с API, чтобы первый запрос не платил за handshake.
+
+    Модели кэшируются в _models вместе с их клиентом, поэтому открытый канал переиспользуется
+    всеми последующими вызовами; count_tokens — самый дешёвый запрос, который его поднимает.
+    """
+
+    await asyncio.gather(*[_warm_up_key(index) for index in range(_api_keys.size)])
+
+
+async def _warm_up_key(key_index: int) -> None:
+    model = _get_model(key_index=key_index)
+    if model is None:
+        return
+    try:
+        await asyncio.wait_for(model.count_tokens_async("ping"), timeout=10)
+    except Exception:  # noqa: BLE001
+        logger.debug("Model warm-up request failed for key #%s", key_index, exc_info=True)
+
+
+@functools.lru_cache(maxsize=32)
+def _base_generation_config(
+    temperature: float, max_output_tokens: Optional[int], json_mode: bool = False
+) -> Dict[str, Any]:
+    """generation_config для (температура, лимит токенов, JSON); результат общий — не изменять.
+
+    В JSON-режиме модель возвращает только JSON (без markdown-обёрток и пояснений).
+    """
+
+    config: Dict[str, Any] = {"temperature": temperature}
+    if max_output_tokens is not None:
+        config["max_output_tokens"] = max_output_tokens
+    if json_mode:
+        config["response_mime_type"] = "application/json"
+    return config
+
+
+_MAX_TOKENS_REPLY = "Не удалось сгенерировать ответ из-за ограничения по длине. Попробуйте задать вопрос короче."
+
+_response_cache = ResponseCache(CONFIG.ai_cache_size, CONFIG.ai_cache_ttl_seconds)
+_intent_cache = SemanticCache(CONFIG.ai_cache_size, CONFIG.ai_semantic_threshold, CONFIG.ai_cache_ttl_seconds)
+_plan_cache = ResponseCache(CONFIG.ai_cache_size, CONFIG.ai_cache_ttl_seconds)
+_inflight_calls = SingleFlight()
+_context_cache = ResponseCache(1024, CONFIG.ai_context_cache_ttl_seconds)
+_tasks_summary_cache = ResponseCache(1024, CONFIG.ai_context_cache_ttl_seconds)
+_embedding_cache = ResponseCache(4 * CONFIG.ai_cache_size, CONFIG.ai_cache_ttl_seconds)
+
+# Счётчики попаданий кэшей пишутся в лог не чаще этого интервала
+_CACHE_STATS_INTERVAL_SECONDS = 300.0
+_cache_stats_logged_at = time.monotonic()
+
+_CONTEXT_DEPENDENT_WORDS = frozenset(
+    {"это", "эта", "этот", "эту", "этой", "того", "та", "тот", "ту", "той", "его", "ее", "их", "ему", "ей", "им", "там", "туда", "он", "она", "оно", "они"}
+)
+_PLAN_CACHE_SKIP_INTENTS = frozenset({"UPDATE", "DELETE"})
+_REVIEW_OPTIONAL_INTENTS = frozenset({"CREATE", "READ"})
+_SKIP_REVIEW_CONFIDENCE = 0.85
+_NO_PARAMS_METHODS = frozenset({"chat", "show_help", "clarify"})
+_SKIP_REVIEW_TRIVIAL_CONFIDENCE = 0.8
+_PLAN_CACHE_TEXT_FIELDS = ("title", "description", "summary", "body")
+
+_METHOD_NAMES = (
+    "create_personal_task",
+    "update_personal_task",
+    "list_personal_tasks",
+    "create_team_task",
+    "update_team_task",
+    "list_team_tasks",
+    "create_or_update_calendar_event",
+    "show_calendar_agenda",
+    "write_personal_note",
+    "read_personal_notes",
+    "search_personal_notes",
+    "update_personal_note",
+    "delete_personal_note",
+    "chat",
+    "clarify",
+    "show_help",
+)
+_ALLOWED_METHODS = frozenset(_METHOD_NAMES)
+_METHODS_DESCRIPTION = ", ".join(_METHOD_NAMES)
+
+_TOPICS = ("PERSONAL_TASK", "TEAM_TASK", "PERSONAL_NOTE", "CALENDAR", "CHAT", "OTHER")
+_INTENTS = ("CREATE", "READ", "UPDATE", "DELETE", "OTHER")
+_TOPIC_SET = frozenset(_TOPICS)
+_INTENT_SET = frozenset(_INTENTS)
+_COMPLEXITIES = ("simple", "medium", "complex")
+_COMPLEXITY_SET = frozenset(_COMPLEXITIES)
+_INTENT_SCHEMA = (
+    f"{{\"topic\": \"{'|'.join(_TOPICS)}\", \"intent\": \"{'|'.join(_INTENTS)}\","
+    f" \"rough_method\": string, \"complexity\": \"{'|'.join(_COMPLEXITIES)}\", \"confidence\": 0..1}}"
+)
+
+
+def _enum_schema(values: tuple[str, ...], nullable: bool = False) -> dict:
+    return {"type": "STRING", "format": "enum", "enum": list(values), "nullable": nullable}
+
+
+_STRING_SCHEMA = {"type": "STRING", "nullable": True}
+_STRING_LIST_SCHEMA = {"type": "ARRAY", "items": {"type": "STRING"}, "nullable": True}
+
+# response_schema для этапов с фиксированной формой ответа: модель обязана вернуть валидный JSON
+# этой структуры, поэтому описывать формат в промте не нужно. План (params) и объединённый ответ
+# содержат произвольные объекты, которые схемой не выразить, — для них остаётся только JSON-режим.
+_INTENT_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "topic": _enum_schema(_TOPICS),
+        "intent": _enum_schema(_INTENTS),
+        "rough_method": {"type": "STRING"},
+        "complexity": _enum_schema(_COMPLEXITIES),
+        "confidence": {"type": "NUMBER"},
+    },
+    "required": ["topic", "intent", "confidence"],
+}
+
+_REVIEW_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "quality": {"type": "NUMBER"},
+        "problems": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "clarify_question": _STRING_SCHEMA,
+    },
+    "required": ["quality", "problems"],
+}
+
+_TASK_FIELDS_SCHEMA = {
+    "title": _STRING_SCHEMA,
+    "description": _STRING_SCHEMA,
+    "due_datetime_local": _STRING_SCHEMA,
+    "priority": _enum_schema(("low", "medium", "high"), nullable=True),
+    "tags": _STRING_LIST_SCHEMA,
+    "assignees": _STRING_LIST_SCHEMA,
+}
+_CALENDAR_FIELDS_SCHEMA = {
+    "summary": _STRING_SCHEMA,
+    "start_datetime_local": _STRING_SCHEMA,
+    "end_datetime_local": _STRING_SCHEMA,
+    "all_day": {"type": "BOOLEAN", "nullable": True},
+}
+_NOTE_FIELDS_SCHEMA = {"title": _STRING_SCHEMA, "body": _STRING_SCHEMA}
+
+_EXTRACT_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {**_TASK_FIELDS_SCHEMA, **_CALENDAR_FIELDS_SCHEMA, **_NOTE_FIELDS_SCHEMA},
+}
+_EXTRACT_RESPONSE_SCHEMA_BY_TOPIC = {
+    topic: {"type": "OBJECT", "properties": fields}
+    for topic, fields in (
+        ("PERSONAL_TASK", _TASK_FIELDS_SCHEMA),
+        ("TEAM_TASK", _TASK_FIELDS_SCHEMA),
+        ("CALENDAR", _CALENDAR_FIELDS_SCHEMA),
+        ("PERSONAL_NOTE", _NOTE_FIELDS_SCHEMA),
+    )
+}
+
+
+# Статичные части промтов собираются один раз при импорте и передаются модели как system_instruction;
+# в запросе отправляются только контекст, запрос пользователя и сериализованные данные этапов.
+_INTENT_INSTRUCTIONS = (
+    "Ты — системный классификатор намерений. Определи тему (topic) и намерение (intent) запроса пользователя,"
+    " примерный метод (rough_method), сложность (complexity) и уверенность (confidence) от 0 до 1.\n"
+    "Используй контекст и историю для понимания местоимений.\n"
+)
+
+_EXTRACT_HEADER = "Ты извлекаешь структурированные поля из запроса пользователя.\n"
+_EXTRACT_TASK_FIELDS = (
+    "- PERSONAL_TASK/TEAM_TASK: title, description, due_datetime_local (ISO с учетом часового пояса пользователя),"
+    " priority (low|medium|high), tags (list[str]), assignees (list[str]) для командных задач.\n"
+)
+_EXTRACT_CALENDAR_FIELDS = "- CALENDAR: summary, start_datetime_local, end_datetime_local, all_day (bool).\n"
+_EXTRACT_NOTE_FIELDS = "- PERSONAL_NOTE: title (может быть пустым), body.\n"
+_EXTRACT_CONTEXT_HINT = "Используй CONTEXT для разрешения местоимений и ссылок на предыдущие действия.\n"
+
+_EXTRACT_INSTRUCTIONS = (
+    _EXTRACT_HEADER
+    + "Для разных topic поля такие:\n"
+    + _EXTRACT_TASK_FIELDS
+    + _EXTRACT_CALENDAR_FIELDS
+    + _EXTRACT_NOTE_FIELDS
+    + "Поля других topic — null.\n"
+    + _EXTRACT_CONTEXT_HINT
+)
+
+# Если тема уже известна, модель видит только схему полей этой темы
+_EXTRACT_INSTRUCTIONS_BY_TOPIC = {
+    topic: (
+        _EXTRACT_HEADER + "Поля:\n" + fields + _EXTRACT_CONTEXT_HINT
+    )
+    for topic, fields in (
+        ("PERSONAL_TASK", _EXTRACT_TASK_FIELDS),
+        ("TEAM_TASK", _EXTRACT_TASK_FIELDS),
+        ("CALENDAR", _EXTRACT_CALENDAR_FIELDS),
+        ("PERSONAL_NOTE", _EXTRACT_NOTE_FIELDS),
+    )
+}
+
+_SHEETS_RULE = (
+    "Задачи и заметки сохраняй в Google Sheets методами создания/обновления: таблицы PersonalTasks, TeamTasks,"
+    " PersonalNotes уже созданы — не отвечай, что таблицы нет.\n"
+)
+_PLAN_FORMAT = (
+    "{\"method\": string, \"params\": {...}, \"user_visible_answer\": string, \"confidence\": 0..1,"
+    " \"clarify_question\": null|string}"
+)
+_REVIEW_FORMAT = "{\"quality\": 0..1, \"problems\": [...], \"clarify_question\": null|string}"
+
+_PLAN_INSTRUCTIONS = (
+    "Ты планировщик действий. По intent и извлечённым данным выбери метод и параметры.\n"
+    f"Методы: {_METHODS_DESCRIPTION}.\n"
+    + _SHEETS_RULE
+    + "Разговор — method='chat'; данных мало — method='clarify' с clarify_question.\n"
+    f"Формат плана: {_PLAN_FORMAT}.\n"
+)
+
+_REVIEW_INSTRUCTIONS = (
+    "Ты ревизор плана. Проверь, хватает ли данных в plan.params для безопасного выполнения:"
+    " дата/время, полнота описания, соответствие метода intent.\n"
+    "Дай quality (0..1) и problems; при сомнениях задай clarify_question.\n"
+)
+
+# План и его ревью одним вызовом: ревизору нужен только сам план, поэтому ждать отдельного ответа незачем
+_PLAN_REVIEW_INSTRUCTIONS = (
+    _PLAN_INSTRUCTIONS
+    + "Затем проверь получившийся план.\n"
+    + _REVIEW_INSTRUCTIONS
+    + f"Верни один JSON-объект {{\"plan\": {{...}}, \"review\": {_REVIEW_FORMAT}}}.\n"
+)
+
+_FUSED_INSTRUCTIONS = (
+    "Ты — планировщик действий ассистента. Выполни четыре шага и верни один JSON-объект"
+    " {\"intent\": {...}, \"structured\": {...}, \"plan\": {...}, \"review\": {...}}.\n"
+    f"1. intent: {_INTENT_SCHEMA}.\n"
+    "2. structured — поля для topic, остальные null:\n"
+    + _EXTRACT_TASK_FIELDS
+    + _EXTRACT_CALENDAR_FIELDS
+    + _EXTRACT_NOTE_FIELDS
+    + f"3. plan: {_PLAN_FORMAT}. Методы: {_METHODS_DESCRIPTION}.\n"
+    + _SHEETS_RULE
+    + "Разговор — method='chat' и краткий ответ на русском в user_visible_answer;"
+    " данных мало — method='clarify' с clarify_question.\n"
+    f"4. review — хватает ли данных в plan.params (дата/время, полнота, соответствие методу): {_REVIEW_FORMAT}.\n"
+    + _EXTRACT_CONTEXT_HINT
+)
+
+_JSON_ONLY_SUFFIX = "Отвечай только JSON."
+
+# Контекст пользователя передаётся в компактном построчном формате; легенда приводится один раз
+# в заголовке секции, а не повторяется в каждой строке
+_CONTEXT_HEADER = (
+    "=== КОНТЕКСТ (P|имя|часовой пояс|email; H|u — пользователь, a — ассистент|реплика;"
+    " A|последнее действие ассистента; T|сводка задач и заметок) ===\n"
+)
+
+# Шаблоны свободных ответов: подстановка через format_map, фигурные скобки в данных не интерпретируются
+_FREE_CHAT_TEMPLATE = (
+    "Ты — дружелюбный ассистент. Отвечай кратко и по делу на русском языке. "
+    "Используй контекст только если он действительно нужен.\n"
+    + _CONTEXT_HEADER
+    + "{context}\n"
+    "Запрос: {question}\n"
+)
+
+_REMINDER_TEMPLATE = (
+    "Ты — персональный ассистент и секретарь.\n"
+    "Пользователь: {user_name}\n"
+    "Нужно составить краткое напоминание о его задачах.\n"
+    "Список задач:\n{tasks}\n"
+    "Сделай: вежливое обращение к пользователю по имени; короткий текст напоминания;"
+    " перечисли задачи по пунктам.\n"
+    "Ответ отдай одним цельным текстом на русском языке."
+)
+
+# Напоминания для нескольких пользователей за один вызов модели
+_REMINDER_BATCH_SIZE = 8
+_REMINDER_BATCH_TEMPLATE = (
+    "Ты — персональный ассистент и секретарь.\n"
+    "Нужно составить краткие напоминания о задачах для каждого пользователя из списка USERS.\n"
+    "Для каждого: вежливое обращение к пользователю по имени; короткий текст напоминания;"
+    " перечисли задачи по пунктам. Тексты на русском языке.\n"
+    "Верни reminders — по одному цельному тексту на пользователя, в том же порядке, что и USERS.\n"
+    "USERS (JSON):\n{users}\n"
+)
+_REMINDER_BATCH_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"reminders": {"type": "ARRAY", "items": {"type": "STRING"}}},
+    "required": ["reminders"],
+}
 
 
 def _normalize_finish_reason(value: Any) -> str:
@@ -64,190 +497,630 @@ async def _call_model(
     temperature: float = 0.2,
     max_output_tokens: int | None = 1024,
     extra_config: dict | None = None,
-
     retry_without_context: bool = False,
+    json_mode: bool = False,
+    system_instruction: Optional[str] = None,
 ) -> Optional[str]:
-    """Безопасный вызов модели Gemini с обработкой всех вариантов ответа."""
+    """Вызов модели с кэшем ответов для детерминированных (низкая температура) запросов.
 
-    prompt = truncate_text(prompt, 12000)
+    Одинаковые запросы, пришедшие одновременно, объединяются в один вызов модели.
+    system_instruction — статичные инструкции этапа: они задаются модели один раз, а не
+    пересылаются в каждом промте, и образуют общий префикс, который API кэширует.
+    """
 
-    def _sync_call(current_prompt: str, current_max_tokens: int | None) -> tuple[Optional[str], dict]:
-        meta: dict = {
-            "finish_reason": "NONE",
-            "usage_metadata": None,
-            "prompt_feedback": None,
-        }
+    _log_cache_stats_if_due()
+    key = make_key(
+        m=CONFIG.AI_MODEL,
+        t=temperature,
+        mx=max_output_tokens,
+        x=extra_config,
+        r=retry_without_context,
+        s=system_instruction,
+        p=prompt,
+    )
+    cacheable = temperature <= CONFIG.ai_cache_max_temperature
+    if cacheable:
+        cached = _response_cache.get(key)
+        if cached is not None:
+            logger.debug(
+                "Ответ модели взят из кэша | hits=%s misses=%s", _response_cache.hits, _response_cache.misses
+            )
+            return cached
+
+    async def _produce() -> Optional[str]:
+        result = await _generate(
+            prompt,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            extra_config=extra_config,
+            retry_without_context=retry_without_context,
+            json_mode=json_mode,
+            system_instruction=system_instruction,
+        )
+        if cacheable and result and result != _MAX_TOKENS_REPLY:
+            _response_cache.set(key, result)
+        return result
 
-        try:
-            model = genai.GenerativeModel(CONFIG.AI_MODEL)
-        except Exception as e:  # noqa: BLE001
-            logger.exception("Ошибка инициализации модели: %s", e)
-            return None, meta
+    return await _inflight_calls.run(key, _produce)
+
+
+# Минимальный прирост текста (в символах) между вызовами on_chunk при потоковой генерации
+_STREAM_FLUSH_CHARS = 50
 
-        try:
-            generation_config = {"temperature": temperature, **(extra_config or {})}
-            if current_max_tokens is not None:
-                generation_config["max_output_tokens"] = current_max_tokens
-            response = model.generate_content(
-                current_prompt,
-                generation_config=generation_config,
-            )
-        except Exception as e:  # noqa: BLE001
-            logger.exception("Ошибка вызова модели: %s", e)
-            return None, meta
 
+async def _call_model_stream(
+    prompt: str,
+    *,
+    temperature: float = 0.3,
+    max_output_tokens: int | None = 1024,
+    extra_config: dict | None = None,
+) -> AsyncIterator[str]:
+    """Потоковый вызов модели: отдаёт фрагменты текста по мере генерации.
+
+    Без кэша и повторов — для свободного текста, который показывается пользователю сразу;
+    JSON-этапы по-прежнему идут через _call_model. Исчерпанная квота (429) до первого фрагмента
+    ставит ключ на паузу и перезапускает поток через свободный ключ пула; после начала ответа
+    ошибка пробрасывается, и вызывающий переходит к обычному вызову модели.
+    """
+
+    key_index = _api_keys.acquire()
+    model = _get_model(key_index=key_index)
+    if model is None:
+        return
+    generation_config = _base_generation_config(temperature, max_output_tokens)
+    if extra_config:
+        generation_config = {**generation_config, **extra_config}
+    # Поток читается отдельной задачей через очередь: слот _model_slots занят только чтением ответа,
+    # а не временем, которое потребитель тратит между фрагментами (например, на правку сообщения)
+    queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+
+    async def pump() -> None:
+        nonlocal key_index, model
+        prompt_text = truncate_to_tokens(prompt, _MAX_PROMPT_TOKENS)
+        async with _model_slots:
+            while True:
+                started = False
+                try:
+                    response = await model.generate_content_async(
+                        prompt_text,
+                        generation_config=generation_config,
+                        stream=True,
+                    )
+                    async with contextlib.aclosing(aiter(response)) as chunks:
+                        async for chunk in chunks:
+                            try:
+                                piece = chunk.text
+                            except Exception:  # noqa: BLE001 — фрагмент без текста (например, только finish_reason)
+                                continue
+                            if piece:
+                                started = True
+                                queue.put_nowait(piece)
+                    return
+                except google_exceptions.ResourceExhausted:
+                    # cool_down истинно, только пока в пуле есть ключ не на паузе, поэтому цикл конечен
+                    if started or not _api_keys.cool_down(key_index):
+                        raise
+                    logger.warning(
+                        "Квота API-ключа #%s исчерпана (запросов через ключ: %s), пауза %s с",
+                        key_index,
+                        _api_keys.usage[key_index],
+                        _api_keys.cooldown_seconds,
+                    )
+                    key_index = _api_keys.acquire()
+                    model = _get_model(key_index=key_index) or model
+
+    pump_task = asyncio.create_task(pump())
+    pump_task.add_done_callback(lambda _task: queue.put_nowait(None))
+    try:
+        while (piece := await queue.get()) is not None:
+            yield piece
+        await pump_task
+    finally:
+        pump_task.cancel()
+
+
+async def _stream_text(
+    prompt: str,
+    on_chunk: ChunkCallback,
+    *,
+    temperature: float,
+    max_output_tokens: int | None,
+    extra_config: dict | None = None,
+) -> Optional[str]:
+    """Собирает потоковый ответ, передавая on_chunk накопленный текст по мере генерации.
+
+    Мелкие фрагменты копятся, пока не наберётся _STREAM_FLUSH_CHARS новых символов, чтобы не
+    дёргать Telegram на каждый токен; остаток отдаётся в конце. Ошибка колбэка не прерывает
+    генерацию. Если поток оборвался ошибкой модели, возвращается None: обрезанный текст не выдаётся
+    за ответ, и вызывающий переходит к обычному вызову модели.
+    """
+
+    pieces: list[str] = []
+    pending = 0
+    notify = True
+
+    async def flush() -> None:
+        nonlocal pending, notify
+        pending = 0
         try:
-            candidates = list(getattr(response, "candidates", None) or [])
+            await on_chunk("".join(pieces))
         except Exception:  # noqa: BLE001
-            candidates = []
+            logger.warning("Не удалось показать промежуточный ответ модели", exc_info=True)
+            notify = False
 
-        finish_reason_raw = None
-        if candidates:
-            try:
-                finish_reason_raw = getattr(candidates[0], "finish_reason", None)
-            except Exception:  # noqa: BLE001
-                finish_reason_raw = None
-        meta["finish_reason"] = _normalize_finish_reason(finish_reason_raw)
-        meta["usage_metadata"] = getattr(response, "usage_metadata", None)
-        meta["prompt_feedback"] = getattr(response, "prompt_feedback", None)
+    try:
+        async for piece in _call_model_stream(
+            prompt, temperature=temperature, max_output_tokens=max_output_tokens, extra_config=extra_config
+        ):
+            pieces.append(piece)
+            pending += len(piece)
+            if notify and pending >= _STREAM_FLUSH_CHARS:
+                await flush()
+    except Exception:  # noqa: BLE001
+        logger.exception("Ошибка потокового вызова модели, получено символов: %s", sum(map(len, pieces)))
+        return None
+    if notify and pending:
+        await flush()
+    return "".join(pieces) or None
 
-        try:
-            text = response.text  # может бросить ValueError
-            if text:
-                return text, meta
-        except Exception as e:  # noqa: BLE001
-            logger.debug("Модель не вернула .text, пробуем кандидатов: %s", e)
 
-        if not candidates:
-            logger.warning("Модель вернула пустой список candidates")
-            return None, meta
+def _log_cache_stats_if_due() -> None:
+    """Периодически пишет в лог попадания/промахи кэшей (hits/misses), чтобы видеть их эффективность."""
 
-        candidate = candidates[0]
-        finish_reason = meta.get("finish_reason", "OTHER")
+    global _cache_stats_logged_at
+    now = time.monotonic()
+    if now - _cache_stats_logged_at < _CACHE_STATS_INTERVAL_SECONDS:
+        return
+    _cache_stats_logged_at = now
+    logger.info(
+        "AI cache stats (hits/misses) | responses %s/%s | intents %s/%s | plans %s/%s | contexts %s/%s | tasks %s/%s | embeddings %s/%s",
+        _response_cache.hits,
+        _response_cache.misses,
+        _intent_cache.hits,
+        _intent_cache.misses,
+        _plan_cache.hits,
+        _plan_cache.misses,
+        _context_cache.hits,
+        _context_cache.misses,
+        _tasks_summary_cache.hits,
+        _tasks_summary_cache.misses,
+        _embedding_cache.hits,
+        _embedding_cache.misses,
+    )
 
-        blocked_reasons = {
-            "SAFETY",
-            "BLOCKLIST",
-            "PROHIBITED_CONTENT",
-            "SPII",
-            "OTHER",
-            "RECITATION",
-        }
-        if finish_reason in blocked_reasons:
-            logger.warning(
-                "Модель завершилась с проблемной finish_reason='%s', текст не используем | usage=%r | prompt_feedback=%r",
-                finish_reason,
-                meta.get("usage_metadata"),
-                meta.get("prompt_feedback"),
-            )
-            return None, meta
 
-        content = getattr(candidate, "content", None)
-        parts = getattr(content, "parts", None) if content is not None else None
+async def load_response_cache() -> None:
+    """Загружает кэш ответов модели с диска (CONFIG.ai_cache_path), если путь задан.
 
-        texts: list[str] = []
-        if parts:
-            for part in parts:
-                t = getattr(part, "text", None)
-                if t:
-                    texts.append(t)
+    Файл читается и разбирается в отдельном потоке, а записи добавляются в кэш в потоке event loop,
+    как и при сохранении.
+    """
 
-        if finish_reason == "MAX_TOKENS" and not texts:
-            logger.warning(
-                "finish_reason='MAX_TOKENS' без текстовых частей | usage=%r | prompt_feedback=%r",
-                meta.get("usage_metadata"),
-                meta.get("prompt_feedback"),
-            )
-            return None, meta
+    if CONFIG.ai_cache_path is None:
+        return
+    try:
+        entries = await asyncio.to_thread(ResponseCache.read_snapshot, CONFIG.ai_cache_path)
+        loaded = _response_cache.restore(entries)
+        logger.info("Loaded %s cached model responses from %s", loaded, CONFIG.ai_cache_path)
+    except Exception:  # noqa: BLE001
+        logger.warning("Failed to load model response cache from %s", CONFIG.ai_cache_path, exc_info=True)
 
-        if not texts:
-            logger.warning(
-                "Кандидат без текста, finish_reason='%s' | usage=%r | prompt_feedback=%r",
-                finish_reason,
-                meta.get("usage_metadata"),
-                meta.get("prompt_feedback"),
-            )
-            return None, meta
 
-        return "\n".join(texts), meta
+async def save_response_cache() -> None:
+    """Сохраняет кэш ответов модели на диск, чтобы он пережил перезапуск бота.
 
-    def _extract_user_request(text: str) -> str:
-        for marker in ["=== Новый запрос пользователя ===", "=== ЗАПРОС ===", "=== ЗАПРОС ПОЛЬЗОВАТЕЛЯ ==="]:
-            if marker in text:
-                return text.split(marker, 1)[-1].strip()
-        return text
+    Снимок записей берётся в потоке event loop, где кэш могут менять другие задачи;
+    в файл он пишется в отдельном потоке.
+    """
 
+    if CONFIG.ai_cache_path is None:
+        return
     try:
-        result, meta = await asyncio.to_thread(_sync_call, prompt, max_output_tokens)
-        finish_reason = _normalize_finish_reason(meta.get("finish_reason"))
+        entries = _response_cache.snapshot()
+        saved = await asyncio.to_thread(ResponseCache.write_snapshot, CONFIG.ai_cache_path, entries)
+        logger.info("Saved %s cached model responses to %s", saved, CONFIG.ai_cache_path)
+    except Exception:  # noqa: BLE001
+        logger.warning("Failed to save model response cache to %s", CONFIG.ai_cache_path, exc_info=True)
 
-        if result:
-            return result
 
-        if finish_reason == "MAX_TOKENS":
-            logger.warning(
-                "Пустой ответ от модели: finish_reason='MAX_TOKENS' | usage=%r | prompt_feedback=%r",
-                meta.get("usage_metadata"),
-                meta.get("prompt_feedback"),
-            )
-            expanded_tokens = None if max_output_tokens is None else max(max_output_tokens * 2, 2048)
+class _JsonObjectScanner:
+    """Инкрементально отслеживает глубину скобок JSON-объекта, пропуская содержимое строк.
+
+    feed() возвращает длину завершённого объекта в накопленном тексте или -1, пока он не закрыт.
+    Если текст начинается не с «{», сканер отключается (failed) и объект не ищется.
+    """
+
+    __slots__ = ("depth", "in_string", "escape", "offset", "failed")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.offset = 0
+        self.failed = False
+
+    def feed(self, piece: str) -> int:
+        for index, char in enumerate(piece):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return self.offset + index + 1
+            elif self.depth == 0 and not char.isspace():
+                self.failed = True
+                return -1
+        self.offset += len(piece)
+        return -1
+
+
+async def _stream_json(model: Any, prompt: str, generation_config: dict) -> tuple[Any, Optional[str]]:
+    """Читает потоковый ответ модели и останавливается, как только закрыт JSON-объект верхнего уровня.
+
+    Возвращает (response, text); text равен None, если поток закончился без полного JSON —
+    тогда response уже содержит агрегированный ответ для обычной обработки.
+    """
+
+    response = await model.generate_content_async(
+        prompt,
+        generation_config=generation_config,
+        stream=True,
+    )
+    scanner = _JsonObjectScanner()
+    pieces: list[str] = []
+    # Итератор закрывается явно: при раннем выходе поток иначе остаётся открытым до сборки мусора,
+    # и модель продолжает генерировать (и тарифицировать) ненужные токены
+    async with contextlib.aclosing(aiter(response)) as chunks:
+        async for chunk in chunks:
             try:
-                retry_result, retry_meta = await asyncio.to_thread(
-                    _sync_call, prompt, expanded_tokens
-                )
-                if retry_result:
-                    return retry_result
-                logger.warning(
-                    "Повторный вызов после MAX_TOKENS тоже без текста | finish_reason='%s' | usage=%r | prompt_feedback=%r",
-                    _normalize_finish_reason(retry_meta.get("finish_reason")),
-                    retry_meta.get("usage_metadata"),
-                    retry_meta.get("prompt_feedback"),
-                )
+                piece = chunk.text
             except Exception:  # noqa: BLE001
-                logger.exception("Ошибка при повторном вызове модели после MAX_TOKENS")
+                continue
+            if not piece or scanner.failed:
+                continue
+            pieces.append(piece)
+            end = scanner.feed(piece)
+            if end < 0:
+                continue
+            text = "".join(pieces)[:end]
+            if _safe_json_loads(text) is None:
+                scanner.failed = True
+                continue
+            return response, text
+    return response, None
+
+
+async def _request_model(
+    prompt: str,
+    *,
+    temperature: float,
+    max_output_tokens: int | None,
+    extra_config: dict | None,
+    json_mode: bool,
+    model_name: Optional[str] = None,
+    system_instruction: Optional[str] = None,
+) -> tuple[Optional[str], dict]:
+    """Один запрос к модели (по умолчанию CONFIG.AI_MODEL); возвращает текст (или None) и метаданные."""
+
+    meta: dict = {
+        "finish_reason": "NONE",
+        "usage_metadata": None,
+        "prompt_feedback": None,
+    }
 
-        if retry_without_context:
-            try:
-                user_request = _extract_user_request(prompt)
-                simple_prompt = (
-                    "Ответь по-русски на следующий запрос кратко и по делу:\n\n"
-                    f"{user_request}"
-                )
-                simple_prompt = truncate_text(simple_prompt, 4000)
-                retry_result, retry_meta = await asyncio.to_thread(
-                    _sync_call, simple_prompt, 200
-                )
-                if retry_result:
-                    return retry_result
-                finish_reason = _normalize_finish_reason(retry_meta.get("finish_reason"))
+    key_index = _api_keys.acquire()
+    model = _get_model(model_name, key_index, system_instruction)
+    if model is None:
+        return None, meta
+
+    generation_config = _base_generation_config(temperature, max_output_tokens, json_mode)
+    if extra_config:
+        generation_config = {**generation_config, **extra_config}
+    attempt = 0
+    while True:
+        try:
+            async with _model_slots:
+                if json_mode:
+                    response, streamed_text = await _stream_json(model, prompt, generation_config)
+                    if streamed_text:
+                        meta["finish_reason"] = "STOP"
+                        return streamed_text, meta
+                else:
+                    response = await model.generate_content_async(
+                        prompt,
+                        generation_config=generation_config,
+                    )
+            break
+        except _RETRYABLE_ERRORS as e:
+            if attempt >= _RETRY_ATTEMPTS:
+                logger.exception("Ошибка вызова модели после %s повторов: %s", attempt, e)
+                return None, meta
+            if isinstance(e, google_exceptions.ResourceExhausted) and _api_keys.cool_down(key_index):
+                # квота этого ключа исчерпана, но в пуле есть свободный — повторяем сразу через него
                 logger.warning(
-                    "Повтор без контекста не дал результата | finish_reason='%s' | usage=%r | prompt_feedback=%r",
-                    finish_reason,
-                    retry_meta.get("usage_metadata"),
-                    retry_meta.get("prompt_feedback"),
+                    "Квота API-ключа #%s исчерпана (запросов через ключ: %s), пауза %s с",
+                    key_index,
+                    _api_keys.usage[key_index],
+                    _api_keys.cooldown_seconds,
                 )
-            except Exception:  # noqa: BLE001
-                logger.exception("Ошибка при повторном вызове модели без контекста")
+                key_index = _api_keys.acquire()
+                model = _get_model(model_name, key_index, system_instruction) or model
+                attempt += 1
+                continue
+            # full jitter: равномерно в [0, min(cap, base * 2^attempt)], чтобы повторы не шли волной
+            delay = random.uniform(0, min(_RETRY_CAP_SECONDS, _RETRY_BASE_SECONDS * 2**attempt))
+            attempt += 1
+            logger.warning("Временная ошибка модели (%s), повтор %s через %.2f с", type(e).__name__, attempt, delay)
+            await asyncio.sleep(delay)
+        except Exception as e:  # noqa: BLE001
+            logger.exception("Ошибка вызова модели: %s", e)
+            return None, meta
+
+    return _extract_response_text(response, meta)
+
+
+_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+_RETRY_ATTEMPTS = 5
+_RETRY_BASE_SECONDS = 0.5
+_RETRY_CAP_SECONDS = 16.0
+
+_BLOCKED_FINISH_REASONS = frozenset({"SAFETY", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "OTHER", "RECITATION"})
+
+
+def _extract_response_text(response: Any, meta: dict) -> tuple[Optional[str], dict]:
+    """Достаёт текст из ответа модели, заполняя meta; учитывает блокировки и пустых кандидатов.
+
+    Обычно ответ отдаёт готовый .text — тогда кандидаты и метаданные не разбираются вовсе.
+    """
+
+    try:
+        text = response.text  # может бросить ValueError
+    except Exception as e:  # noqa: BLE001
+        logger.debug("Модель не вернула .text, пробуем кандидатов: %s", e)
+    else:
+        if text:
+            meta["finish_reason"] = "STOP"
+            return text, meta
+    return _extract_candidate_text(response, meta)
+
+
+def _extract_candidate_text(response: Any, meta: dict) -> tuple[Optional[str], dict]:
+    """Медленный путь: разбирает первого кандидата, когда .text недоступен или пуст."""
+
+    try:
+        candidate = response.candidates[0]
+    except (AttributeError, IndexError, TypeError):
+        candidate = None
+    try:
+        finish_reason_raw = candidate.finish_reason
+    except AttributeError:
+        finish_reason_raw = None
+    meta["finish_reason"] = _normalize_finish_reason(finish_reason_raw)
+    meta["usage_metadata"] = getattr(response, "usage_metadata", None)
+    meta["prompt_feedback"] = getattr(response, "prompt_feedback", None)
+
+    if candidate is None:
+        logger.warning("Модель вернула пустой список candidates")
+        return None, meta
+
+    finish_reason = meta.get("finish_reason", "OTHER")
+
+    if finish_reason in _BLOCKED_FINISH_REASONS:
+        logger.warning(
+            "Модель завершилась с проблемной finish_reason='%s', текст не используем | usage=%r | prompt_feedback=%r",
+            finish_reason,
+            meta.get("usage_metadata"),
+            meta.get("prompt_feedback"),
+        )
+        return None, meta
+
+    try:
+        texts = [text for part in candidate.content.parts if (text := getattr(part, "text", None))]
+    except (AttributeError, TypeError):
+        texts = []
 
+    if finish_reason == "MAX_TOKENS" and not texts:
+        logger.warning(
+            "finish_reason='MAX_TOKENS' без текстовых частей | usage=%r | prompt_feedback=%r",
+            meta.get("usage_metadata"),
+            meta.get("prompt_feedback"),
+        )
+        return None, meta
+
+    if not texts:
+        logger.warning(
+            "Кандидат без текста, finish_reason='%s' | usage=%r | prompt_feedback=%r",
+            finish_reason,
+            meta.get("usage_metadata"),
+            meta.get("prompt_feedback"),
+        )
+        return None, meta
+
+    return "\n".join(texts), meta
+
+
+# Маркеры начала запроса пользователя в промте; один проход регулярки вместо поиска каждого маркера
+_USER_REQUEST_MARKER_RE = re.compile(r"=== (?:Новый запрос пользователя|ЗАПРОС(?: ПОЛЬЗОВАТЕЛЯ)?) ===")
+
+
+def _extract_user_request(text: str) -> str:
+    parts = _USER_REQUEST_MARKER_RE.split(text, maxsplit=1)
+    return parts[-1].strip() if len(parts) > 1 else text
+
+
+async def _generate(
+    prompt: str,
+    *,
+    temperature: float = 0.2,
+    max_output_tokens: int | None = 1024,
+    extra_config: dict | None = None,
+    retry_without_context: bool = False,
+    json_mode: bool = False,
+    system_instruction: Optional[str] = None,
+) -> Optional[str]:
+    """Безопасный вызов модели Gemini с обработкой всех вариантов ответа.
+
+    При json_mode ответ читается потоком и чтение прекращается, как только получен полный JSON.
+    Пустой ответ повторяется по списку попыток: с увеличенным лимитом токенов (после MAX_TOKENS)
+    и с коротким промтом без контекста (retry_without_context); возвращается первый текст.
+    Если заданы резервные модели (CONFIG.ai_model_fallbacks), повтор после MAX_TOKENS или
+    блокировки ответа идёт через первую из них, а не через ту же модель.
+    """
+
+    prompt = truncate_to_tokens(prompt, _MAX_PROMPT_TOKENS)
+    request_args = {
+        "temperature": temperature,
+        "extra_config": extra_config,
+        "json_mode": json_mode,
+        "system_instruction": system_instruction,
+    }
+
+    try:
+        result, meta = await _request_model(prompt, **request_args, max_output_tokens=max_output_tokens)
+        if result:
+            return result
+        finish_reason = _normalize_finish_reason(meta.get("finish_reason"))
         logger.warning(
             "Пустой ответ от модели: finish_reason='%s' | usage=%r | prompt_feedback=%r",
             finish_reason,
             meta.get("usage_metadata"),
             meta.get("prompt_feedback"),
         )
+
+        fallback_model = CONFIG.ai_model_fallbacks[0] if CONFIG.ai_model_fallbacks else None
+        attempts: list[tuple[str, str, int | None, Optional[str]]] = []
         if finish_reason == "MAX_TOKENS":
-            return "Не удалось сгенерировать ответ из-за ограничения по длине. Попробуйте задать вопрос короче."
+            expanded_tokens = None if max_output_tokens is None else max(max_output_tokens * 2, 2048)
+            attempts.append(("после MAX_TOKENS", prompt, expanded_tokens, fallback_model))
+        elif finish_reason in _BLOCKED_FINISH_REASONS and fallback_model:
+            attempts.append((f"после {finish_reason}", prompt, max_output_tokens, fallback_model))
+        if retry_without_context:
+            simple_prompt = truncate_text(
+                f"Ответь по-русски на следующий запрос кратко и по делу:\n\n{_extract_user_request(prompt)}", 4000
+            )
+            attempts.append(("без контекста", simple_prompt, 200, None))
+
+        for label, attempt_prompt, attempt_tokens, attempt_model in attempts:
+            result, meta = await _request_model(
+                attempt_prompt, **request_args, max_output_tokens=attempt_tokens, model_name=attempt_model
+            )
+            if result:
+                return result
+            finish_reason = _normalize_finish_reason(meta.get("finish_reason"))
+            logger.warning(
+                "Повтор %s не дал результата | finish_reason='%s' | usage=%r | prompt_feedback=%r",
+                label,
+                finish_reason,
+                meta.get("usage_metadata"),
+                meta.get("prompt_feedback"),
+            )
+
+        if finish_reason == "MAX_TOKENS":
+            return _MAX_TOKENS_REPLY
     except Exception:  # noqa: BLE001
         logger.exception("Ошибка при вызове модели")
     return None
 
 
+async def _embed_text(text: str) -> Optional["array[float]"]:
+    """Возвращает эмбеддинг текста для семантического кэша или None при ошибке.
+
+    Эмбеддинги запоминаются по тексту, одновременные запросы одного текста объединяются.
+    Запрос всегда идёт через ключ по умолчанию (genai.configure) и не участвует в ротации пула:
+    при ошибке, в том числе 429, семантический кэш просто пропускается.
+    """
+
+    if not CONFIG.ai_semantic_cache or not text:
+        return None
+    key = make_key(e=CONFIG.ai_embedding_model, p=text)
+    cached = _embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def _produce() -> Optional["array[float]"]:
+        try:
+            _ensure_configured()
+            result = await genai.embed_content_async(
+                model=CONFIG.ai_embedding_model,
+                content=text,
+                task_type="semantic_similarity",
+            )
+            embedding = result.get("embedding") if isinstance(result, dict) else None
+        except Exception:  # noqa: BLE001
+            logger.debug("Failed to embed text for semantic cache", exc_info=True)
+            return None
+        if not embedding:
+            return None
+        vector = array("f", embedding)
+        _embedding_cache.set(key, vector)
+        return vector
+
+    return await _inflight_calls.run(key, _produce)
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
 def _safe_json_loads(text: str) -> Optional[dict]:
-    try:
-        return json.loads(text)
-    except Exception:  # noqa: BLE001
-        logger.debug("Failed to parse JSON from model output: %r", text, exc_info=True)
+    if not text:
         return None
+    try:
+        parsed = _json_loads(text)
+    except (ValueError, TypeError):  # JSONDecodeError и orjson, и stdlib — подклассы ValueError
+        parsed = _extract_json_object(text)
+        if parsed is None:
+            logger.debug("Failed to parse JSON from model output: %r", text)
+            return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _extract_json_object(text: str) -> Optional[dict]:
+    """Достаёт первый разбираемый JSON-объект из прозы или markdown-блока ```json … ```."""
+
+    fenced = _CODE_FENCE_RE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    while start >= 0:
+        end = _JsonObjectScanner().feed(text[start:])
+        if end < 0:
+            return None
+        try:
+            parsed = _json_loads(text[start : start + end])
+        except (ValueError, TypeError):
+            start = text.find("{", start + 1)
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+        start = text.find("{", start + end)
+    return None
+
+
+def _prompt_json(value: Any) -> str:
+    """Компактная сериализация данных этапов для промта: без пробелов после разделителей."""
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:  # orjson.JSONEncodeError (например, слишком глубокая вложенность) — отдаём stdlib json
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
 
 
 def _is_debug_enabled(profile: dict) -> bool:
@@ -278,17 +1151,276 @@ def _ensure_task_deadline_for_calendar(plan: dict, structured: dict) -> None:
     params = plan.get("params") or {}
     due_dt = structured.get("due_datetime") or structured.get("due_datetime_local")
 
-    if due_dt and not params.get("due_datetime"):
-        params["due_datetime"] = due_dt
-        plan["params"] = params
+    if due_dt and not params.get("due_datetime"):
+        params["due_datetime"] = due_dt
+        plan["params"] = params
+
+
+# Быстрая классификация частых формулировок без вызова модели: тема и действие определяются
+# по ключевым словам, ответ принимается только при однозначном совпадении.
+_TOPIC_RULES = (
+    ("TEAM_TASK", r"командн\w*\s+задач|задач\w*\s+(?:для\s+)?команд|поручи"),
+    ("PERSONAL_TASK", r"задач|туду|todo"),
+    ("PERSONAL_NOTE", r"заметк"),
+    ("CALENDAR", r"календар|встреч|созвон|мероприяти"),
+)
+_INTENT_RULES = (
+    ("CREATE", r"\b(?:созда|добав|запиш|запланир|постав|заведи|внеси)"),
+    ("READ", r"\b(?:покажи|список|какие|выведи|прочитай)"),
+    # Поиск — чтение с фильтром: для заметок у него свой метод, для остальных тем решает модель
+    ("SEARCH", r"\b(?:найди|поиск|ищи)"),
+    ("UPDATE", r"\b(?:измени|перенеси|обнови|отредактир|исправь|отметь)"),
+    ("DELETE", r"\b(?:удали|убери|сотри)"),
+)
+# Все правила одной регуляркой с именованными группами: текст просматривается один раз,
+# имя сработавшей группы (lastgroup) — тема или действие
+_KEYWORD_RE = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in (*_TOPIC_RULES, *_INTENT_RULES)))
+# Уверенность intent по ключевым словам ниже ai_high_confidence: такой результат не кэшируется,
+# а план по нему проходит ревью
+_HEURISTIC_CONFIDENCE = min(0.7, CONFIG.ai_high_confidence - 0.05)
+_RULE_METHODS = {
+    ("PERSONAL_TASK", "CREATE"): "create_personal_task",
+    ("PERSONAL_TASK", "READ"): "list_personal_tasks",
+    ("PERSONAL_TASK", "UPDATE"): "update_personal_task",
+    ("TEAM_TASK", "CREATE"): "create_team_task",
+    ("TEAM_TASK", "READ"): "list_team_tasks",
+    ("TEAM_TASK", "UPDATE"): "update_team_task",
+    ("CALENDAR", "CREATE"): "create_or_update_calendar_event",
+    ("CALENDAR", "READ"): "show_calendar_agenda",
+    ("CALENDAR", "UPDATE"): "create_or_update_calendar_event",
+    ("PERSONAL_NOTE", "CREATE"): "write_personal_note",
+    ("PERSONAL_NOTE", "READ"): "read_personal_notes",
+    ("PERSONAL_NOTE", "SEARCH"): "search_personal_notes",
+    ("PERSONAL_NOTE", "UPDATE"): "update_personal_note",
+    ("PERSONAL_NOTE", "DELETE"): "delete_personal_note",
+}
+# Действия правил, которых нет в схеме intent модели, отдаются под ближайшим её значением
+_RULE_INTENTS = {"SEARCH": "READ"}
+
+
+def _heuristic_intent(canonical_text: str) -> Optional[dict]:
+    """Intent по ключевым словам или None, если формулировка неоднозначна."""
+
+    matched = {match.lastgroup for match in _KEYWORD_RE.finditer(canonical_text)}
+    topics = [topic for topic, _ in _TOPIC_RULES if topic in matched]
+    if "TEAM_TASK" in topics and "PERSONAL_TASK" in topics:
+        topics.remove("PERSONAL_TASK")
+    intents = [intent for intent, _ in _INTENT_RULES if intent in matched]
+    if len(topics) != 1 or len(intents) != 1:
+        return None
+    if topics == ["PERSONAL_TASK"] and "команд" in canonical_text:
+        # «задачи у команды», «команде нужна задача»: личная или командная — решает модель
+        return None
+    method = _RULE_METHODS.get((topics[0], intents[0]))
+    if method is None:
+        return None
+    return {
+        "topic": topics[0],
+        "intent": _RULE_INTENTS.get(intents[0], intents[0]),
+        "rough_method": method,
+        "complexity": "simple",
+        "confidence": _HEURISTIC_CONFIDENCE,
+    }
+
+
+def _mentions_actions(canonical_text: str) -> bool:
+    """Есть ли в тексте хоть одно ключевое слово темы или действия; без них запрос похож на разговор."""
+
+    return _KEYWORD_RE.search(canonical_text) is not None
+
+
+# Короткие реплики без запроса (приветствие, благодарность, прощание) получают готовый ответ
+# без вызова модели; совпадение — только со всем сообщением целиком.
+_SMALL_TALK_REPLIES = (
+    (
+        re.compile(r"(?:привет|приветствую|здравствуй(?:те)?|добрый (?:день|вечер)|доброе утро|хай)(?: бот)?"),
+        "Здравствуйте! Чем могу помочь: задачи, заметки или календарь?",
+    ),
+    (
+        re.compile(r"(?:спасибо|благодарю|спс)(?: (?:большое|огромное))?"),
+        "Пожалуйста! Обращайтесь, если нужно что-то ещё.",
+    ),
+    (
+        re.compile(r"(?:пока|до свидания|до встречи|всего доброго)"),
+        "До встречи! Напомню о задачах, когда подойдёт срок.",
+    ),
+)
+
+
+def _small_talk_reply(canonical_text: str) -> Optional[str]:
+    for pattern, reply in _SMALL_TALK_REPLIES:
+        if pattern.fullmatch(canonical_text):
+            return reply
+    return None
+
+
+def _context_scope(canonical_text: str, context_text: str) -> str:
+    """Область семантического кэша: общая для самостоятельных запросов, отдельная для ссылок на контекст.
+
+    Смысл запроса с местоимениями («перенеси её на завтра») зависит от истории диалога,
+    поэтому такие записи привязываются к отпечатку контекста (профиль, история, действия).
+    """
+
+    if _CONTEXT_DEPENDENT_WORDS.intersection(canonical_text.split()):
+        return make_key(c=context_text)
+    return ""
+
+
+def _canonical_slot(value: Any) -> Any:
+    if isinstance(value, str):
+        return " ".join(unicodedata.normalize("NFKC", value).casefold().split())
+    if isinstance(value, (list, tuple)):
+        # порядок исполнителей и тегов не влияет на план
+        return sorted(str(_canonical_slot(item)) for item in value)
+    return value
+
+
+def _canonical_slots(structured: dict) -> dict:
+    """Слоты без пустых значений, с нормализованным текстом — для ключа кэша плана."""
+
+    return {key: _canonical_slot(value) for key, value in structured.items() if value not in (None, "", [])}
+
+
+def _plan_cache_key(profile: dict, intent: dict, structured: dict) -> Optional[str]:
+    """Ключ кэша плана или None, если план зависит от контекста и кэшировать его нельзя."""
+
+    if _coerce_confidence(intent.get("confidence"), 0.0) < CONFIG.ai_high_confidence:
+        return None
+    if intent.get("intent") in _PLAN_CACHE_SKIP_INTENTS:
+        return None
+
+    texts = [structured.get(field) for field in _PLAN_CACHE_TEXT_FIELDS]
+    texts = [text for text in texts if isinstance(text, str) and text.strip()]
+    if not texts:
+        return None
+    for text in texts:
+        if _CONTEXT_DEPENDENT_WORDS.intersection(canonicalize_text(text).split()):
+            return None
+
+    return make_key(
+        topic=intent.get("topic"),
+        intent=intent.get("intent"),
+        method=intent.get("rough_method"),
+        tz=profile.get("timezone") or "UTC",
+        struct=_canonical_slots(structured),
+    )
+
+
+def _coerce_confidence(value: Any, default: float = 0.5) -> float:
+    value_type = type(value)
+    if value_type is float or value_type is int:
+        result = float(value)
+    elif value is None:
+        result = default
+    else:
+        try:
+            result = float(value)
+        except (TypeError, ValueError):
+            result = default
+    # NaN и отрицательные значения дают 0.0
+    return result if 0.0 <= result <= 1.0 else (1.0 if result > 1.0 else 0.0)
+
+
+def _normalize_intent(parsed: Optional[dict]) -> IntentResult:
+    if not parsed:
+        return {
+            "topic": "CHAT",
+            "intent": "OTHER",
+            "rough_method": "chat",
+            "complexity": "simple",
+            "confidence": 0.5,
+        }
+    # значения вне схемы (опечатки модели, неизвестные темы) сводим к OTHER/значениям по умолчанию
+    topic = parsed.get("topic")
+    intent = parsed.get("intent")
+    rough_method = parsed.get("rough_method")
+    complexity = parsed.get("complexity")
+    return {
+        "topic": topic if topic in _TOPIC_SET else "OTHER",
+        "intent": intent if intent in _INTENT_SET else "OTHER",
+        "rough_method": rough_method if isinstance(rough_method, str) and rough_method else "chat",
+        "complexity": complexity if complexity in _COMPLEXITY_SET else "simple",
+        "confidence": _coerce_confidence(parsed.get("confidence"), 0.5),
+    }
+
+
+def _normalize_structure(parsed: Optional[dict]) -> StructuredFields:
+    parsed = parsed or {}
+    tags = parsed.get("tags") if isinstance(parsed.get("tags"), list) else None
+    assignees = parsed.get("assignees") if isinstance(parsed.get("assignees"), list) else None
+
+    result: StructuredFields = {
+        "title": parsed.get("title"),
+        "description": parsed.get("description"),
+        "due_datetime_local": parsed.get("due_datetime_local"),
+        "priority": parsed.get("priority"),
+        "tags": tags,
+        "assignees": assignees,
+        "summary": parsed.get("summary"),
+        "start_datetime_local": parsed.get("start_datetime_local"),
+        "end_datetime_local": parsed.get("end_datetime_local"),
+        "all_day": parsed.get("all_day"),
+        "body": parsed.get("body"),
+    }
+    return result
+
+
+# Шаблон плана: порядок ключей фиксирован, копия дешевле сборки словаря с нуля
+_DEFAULT_PLAN: dict = {
+    "method": None,
+    "params": None,
+    "user_visible_answer": None,
+    "confidence": 0.0,
+    "clarify_question": None,
+}
+
+
+def _normalize_plan(parsed: Optional[dict], user_text: str) -> Optional[PlanResult]:
+    """Приводит ответ планировщика к плану; None — если метод не распознан."""
+
+    if not parsed:
+        return None
+    method_raw = parsed.get("method") if isinstance(parsed.get("method"), str) else None
+    method = method_raw if method_raw in _ALLOWED_METHODS else None
+    if not method:
+        return None
+    plan = _DEFAULT_PLAN.copy()
+    plan["method"] = method
+    plan["params"] = parsed.get("params") or {}
+    plan["user_visible_answer"] = parsed.get("user_visible_answer") or None
+    plan["confidence"] = _coerce_confidence(parsed.get("confidence"), 0.5 if method == "chat" else 0.7)
+    plan["clarify_question"] = parsed.get("clarify_question")
+    if method == "chat" and not plan["params"].get("question"):
+        plan["params"]["question"] = user_text
+    if method == "clarify" and not plan["clarify_question"]:
+        plan["clarify_question"] = "Мне нужно уточнить детали, чтобы продолжить."
+    return plan
+
+
+def _normalize_review(parsed: Optional[dict]) -> ReviewResult:
+    if not parsed:
+        return {
+            "quality": 0.5,
+            "problems": [],
+            "clarify_question": None,
+        }
+    problems = parsed.get("problems")
+    return {
+        "quality": _coerce_confidence(parsed.get("quality"), 0.5),
+        "problems": problems if isinstance(problems, list) else [],
+        "clarify_question": parsed.get("clarify_question"),
+    }
+
 
+def _build_prompt(
+    context_text: str,
+    user_text: str,
+    *sections: str,
+    suffix: str = "",
+) -> str:
+    """Собирает динамическую часть промта одним join; инструкции этапа идут в system_instruction."""
 
-def _coerce_confidence(value: Any, default: float = 0.5) -> float:
-    try:
-        result = float(value)
-    except (TypeError, ValueError):
-        result = default
-    return max(0.0, min(1.0, result))
+    return "".join((_CONTEXT_HEADER, context_text, "\n", *sections, "=== ЗАПРОС ===\n", user_text, "\n", suffix))
 
 
 def truncate_text(text: str, max_chars: int) -> str:
@@ -310,8 +1442,117 @@ def truncate_text(text: str, max_chars: int) -> str:
     return f"{text[:head_len]}{separator}{text[-tail_len:]}"
 
 
+# Оценка числа токенов без обращения к API: латиница занимает ~4 символа на токен, кириллица
+# и прочие не-ASCII символы — ~3. Этого хватает, чтобы ограничивать промт по токенам, а не символам.
+_ASCII_CHARS_PER_TOKEN = 4
+_OTHER_CHARS_PER_TOKEN = 3
+_MAX_PROMPT_TOKENS = 4000
+
+
+def estimate_tokens(text: str) -> int:
+    # в UTF-8 ASCII занимает байт, кириллица — два: разница длин даёт число не-ASCII символов
+    other_chars = len(text.encode("utf-8")) - len(text)
+    ascii_chars = max(len(text) - other_chars, 0)
+    return -(-ascii_chars // _ASCII_CHARS_PER_TOKEN) + -(-other_chars // _OTHER_CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Как truncate_text, но лимит задан в (оценочных) токенах модели."""
+
+    # Символ весит не больше 1/3 токена (плюс округление двух слагаемых), поэтому короткий текст
+    # заведомо укладывается в лимит и не кодируется в UTF-8 для оценки
+    if len(text) <= (max_tokens - 2) * _OTHER_CHARS_PER_TOKEN:
+        return text
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return truncate_text(text, len(text) * max_tokens // tokens)
+
+
+# Бюджеты символов частей контекста (в сумме с разделителями укладываются в общий лимит 4000);
+# неиспользованный короткими частями остаток достаётся не уложившимся
+_CONTEXT_BUDGETS = {"profile": 400, "history": 1900, "actions": 1200, "tasks": 450}
+
+
+def _fit_items(items: list[str], budget: int) -> list[str]:
+    """Укладывает элементы в общий бюджет, обрезая только самые длинные.
+
+    Ищется порог L, при котором сумма min(len(item), L) не превышает бюджет; короткие элементы
+    остаются целыми, длинные обрезаются до L.
+    """
+
+    total = sum(map(len, items))
+    if total <= budget:
+        return items
+    # Меньше символа на элемент — остались бы одни многоточия, лучше не выводить ничего
+    if budget < len(items):
+        return []
+    remaining = max(budget, 0)
+    lengths = sorted(map(len, items))
+    cap = 0
+    for index, length in enumerate(lengths):
+        left = len(lengths) - index
+        if length * left > remaining:
+            cap = remaining // left
+            break
+        remaining -= length
+    return [item if len(item) <= cap else item[: max(cap - 1, 0)] + "…" for item in items]
+
+
+def _share_spare_budget(needs: Dict[str, int], budgets: Dict[str, int]) -> Dict[str, int]:
+    """Отдаёт остаток бюджетов коротких частей тем, кто в свой бюджет не укладывается.
+
+    Остаток делится поровну; часть, которой нужно меньше своей доли, берёт только нужное,
+    а излишек переходит к остальным.
+    """
+
+    spare = sum(max(budget - needs.get(name, 0), 0) for name, budget in budgets.items())
+    over = sorted(
+        (needs[name] - budget, name)
+        for name, budget in budgets.items()
+        if needs.get(name, 0) > budget
+    )
+    if not spare or not over:
+        return budgets
+    result = dict(budgets)
+    for index, (overflow, name) in enumerate(over):
+        extra = min(overflow, spare // (len(over) - index))
+        result[name] += extra
+        spare -= extra
+    return result
+
+
+def truncate_components(parts: Dict[str, Any], budgets: Dict[str, int]) -> Dict[str, str]:
+    """Обрезает части промта по собственным бюджетам, не трогая укладывающиеся в них.
+
+    Значение части — строка или список строк (например, реплики истории); список укладывается
+    в бюджет через _fit_items и склеивается переводами строк. Части без бюджета не меняются;
+    недобор коротких частей перераспределяется через _share_spare_budget.
+    """
+
+    needs = {
+        name: sum(map(len, value)) + max(len(value) - 1, 0) if isinstance(value, list) else len(value)
+        for name, value in parts.items()
+    }
+    budgets = _share_spare_budget(needs, budgets)
+    result: Dict[str, str] = {}
+    for name, value in parts.items():
+        budget = budgets.get(name)
+        if isinstance(value, list):
+            if budget is not None:
+                value = _fit_items(value, budget - max(len(value) - 1, 0))
+            result[name] = "\n".join(value)
+        else:
+            result[name] = value if budget is None else truncate_text(value, budget)
+    return result
+
+
 async def build_context_for_user(profile: dict) -> str:
-    """Compose context text from profile, dialog history and recent actions."""
+    """Compose context text from profile, dialog history and recent actions.
+
+    The result is memoized per user until the dialog history or action log changes,
+    bounded by CONFIG.ai_context_cache_ttl_seconds so task data from the sheets stays fresh.
+    """
 
     user_id = 0
     try:
@@ -319,15 +1560,6 @@ async def build_context_for_user(profile: dict) -> str:
     except (TypeError, ValueError):
         logger.debug("Invalid telegram_user_id in profile: %r", profile.get("telegram_user_id"))
 
-    history = get_recent_history(user_id, limit=6)
-    actions_summary = get_recent_actions_summary(user_id, limit=3)
-    try:
-        tasks_context = await asyncio.to_thread(google_service.build_context_for_user, profile)
-        tasks_summary = tasks_context.get("summary", "") if isinstance(tasks_context, dict) else ""
-    except Exception:  # noqa: BLE001
-        logger.debug("Failed to build tasks context", exc_info=True)
-        tasks_summary = "Состояние задач из таблицы недоступно."
-
     display_name = (
         profile.get("display_name")
         or profile.get("telegram_full_name")
@@ -337,104 +1569,163 @@ async def build_context_for_user(profile: dict) -> str:
     timezone = profile.get("timezone") or "UTC"
     email = profile.get("calendar_email") or profile.get("email") or "не указан"
 
-    history_lines = ["Краткая история последних сообщений:"]
-    if history:
-        for item in history:
-            role = "Пользователь" if item.get("role") == "user" else "Ассистент"
-            history_lines.append(f"{role}: {item.get('text', '')}")
-    else:
-        history_lines.append("(История пуста)")
-
-    actions_lines = ["Краткое резюме последних действий ассистента:"]
-    actions_lines.append(actions_summary or "(Нет зафиксированных действий)")
-
-    context = (
-        "Профиль пользователя:\n"
-        f"- Имя: {display_name}\n"
-        f"- Часовой пояс: {timezone}\n"
-        f"- Email для календаря: {email}\n\n"
-        + "\n".join(history_lines)
-        + "\n\n"
-        + "\n".join(actions_lines)
-        + "\n\n"
-        + f"Сводка задач и заметок из таблиц: {tasks_summary or 'нет данных'}"
+    cache_key = make_key(
+        u=user_id,
+        h=get_history_version(user_id),
+        a=get_actions_version(user_id),
+        p=(display_name, timezone, email),
     )
-    return truncate_text(context, 4000)
+    cached = _context_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
+    history = get_recent_history(user_id, limit=6)
+    actions_summary = get_recent_actions_summary(user_id, limit=3)
+    tasks_summary = await _get_tasks_summary(profile, user_id)
 
-async def analyze_intent(profile: dict, user_text: str, context_text: str) -> dict:
-    """Определяет тему и намерение запроса."""
-
-    prompt = (
-        "Ты — системный классификатор намерений. Твоя задача: определить тему и намерение запроса пользователя.\n"
-        "Верни JSON строго в формате: {"
-        "\"topic\": \"PERSONAL_TASK|TEAM_TASK|PERSONAL_NOTE|CALENDAR|CHAT|OTHER\","
-        " \"intent\": \"CREATE|READ|UPDATE|DELETE|OTHER\","
-        " \"rough_method\": \"string\", \"complexity\": \"simple|medium|complex\", \"confidence\": 0..1 }.\n"
-        "Никаких пояснений и текста кроме JSON.\n"
-        "Используй контекст и историю для понимания местоимений.\n"
-        f"=== КОНТЕКСТ ===\n{context_text}\n"
-        f"=== ЗАПРОС ===\n{user_text}\n"
+    history_lines = [
+        f"H|{'u' if item.get('role') == 'user' else 'a'}|{str(item.get('text', '')).replace(chr(10), ' ')}"
+        for item in history or ()
+    ]
+    action_lines = [f"A|{line}" for line in actions_summary.splitlines()] if actions_summary else []
+    parts = truncate_components(
+        {
+            "profile": f"P|{display_name}|{timezone}|{email}",
+            "history": history_lines,
+            "actions": action_lines,
+            "tasks": f"T|{tasks_summary or 'нет данных'}",
+        },
+        _CONTEXT_BUDGETS,
     )
-    raw = await _call_model(prompt, temperature=0.1, max_output_tokens=200)
-    parsed = _safe_json_loads(raw or "")
-    if not parsed:
-        return {
-            "topic": "CHAT",
-            "intent": "OTHER",
-            "rough_method": "chat",
-            "complexity": "simple",
-            "confidence": 0.5,
-        }
-    return {
-        "topic": parsed.get("topic", "OTHER"),
-        "intent": parsed.get("intent", "OTHER"),
-        "rough_method": parsed.get("rough_method", "chat"),
-        "complexity": parsed.get("complexity", "simple"),
-        "confidence": _coerce_confidence(parsed.get("confidence"), 0.5),
-    }
+    lines = [part for part in parts.values() if part]
+
+    context = truncate_text("\n".join(lines), 4000)
+    _context_cache.set(cache_key, context)
+    return context
+
+
+async def _get_tasks_summary(profile: dict, user_id: int) -> str:
+    """Сводка задач из таблиц, запомненная до изменения журнала действий пользователя.
+
+    История диалога меняется каждый ход, а задачи — только после действий бота (или правок
+    в таблице, которые подхватываются по истечении TTL), поэтому запрос к Sheets не повторяется
+    на каждое сообщение.
+    """
+
+    cache_key = f"{user_id}:{get_actions_version(user_id)}"
+    cached = _tasks_summary_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        tasks_context = await asyncio.to_thread(google_service.build_context_for_user, profile)
+    except Exception:  # noqa: BLE001
+        logger.debug("Failed to build tasks context", exc_info=True)
+        return "Состояние задач из таблицы недоступно."
+    summary = tasks_context.get("summary", "") if isinstance(tasks_context, dict) else ""
+    _tasks_summary_cache.set(cache_key, summary)
+    return summary
+
+
+async def analyze_intent(profile: dict, user_text: str, context_text: str) -> dict:
+    """Определяет тему и намерение запроса.
+
+    Уверенные результаты кэшируются по каноническому тексту запроса и по близости эмбеддингов,
+    поэтому перефразированный запрос не требует повторного вызова модели. Запросы с местоимениями
+    совпадают только в пределах того же контекста диалога. Однозначные формулировки
+    («создай задачу …», «покажи заметки») классифицируются по ключевым словам без модели.
+    """
+
+    cache_key = canonicalize_text(user_text)
+    heuristic = _heuristic_intent(cache_key)
+    if heuristic is not None:
+        return heuristic
+
+    scope = _context_scope(cache_key, context_text)
+    cached = _intent_cache.get_exact(cache_key, scope)
+    if cached is not None:
+        return dict(cached)
+
+    # Эмбеддинг — такой же сетевой вызов, поэтому он идёт параллельно с классификатором, а не перед ним:
+    # если он пришёл первым и нашёлся похожий запрос, вызов модели отменяется, иначе эмбеддинг
+    # нужен только для сохранения результата в кэш
+    embed_task = asyncio.create_task(_embed_text(cache_key))
+    intent_task = asyncio.create_task(_classify_intent(user_text, context_text))
+    try:
+        await asyncio.wait((embed_task, intent_task), return_when=asyncio.FIRST_COMPLETED)
+        if not intent_task.done() and (embedding := embed_task.result()):
+            cached = _intent_cache.search(embedding, scope)
+            if cached is not None:
+                intent_task.cancel()
+                logger.debug(
+                    "Intent взят из семантического кэша | hits=%s misses=%s", _intent_cache.hits, _intent_cache.misses
+                )
+                return dict(cached)
+        intent = await intent_task
+    except BaseException:
+        embed_task.cancel()
+        intent_task.cancel()
+        raise
+
+    if cache_key and intent["confidence"] >= CONFIG.ai_high_confidence:
+        _intent_cache.add(cache_key, None, dict(intent), scope)
+        # вектор дописывается, когда эмбеддинг готов; ответ его не ждёт
+        embed_task.add_done_callback(functools.partial(_store_intent_embedding, cache_key, dict(intent), scope))
+    else:
+        embed_task.cancel()
+    return intent
 
 
-async def extract_structure(profile: dict, user_text: str, context_text: str, intent: dict) -> dict:
-    """Извлекает структурированные данные в зависимости от темы."""
-
-    prompt = (
-        "Ты извлекаешь структурированные поля из запроса пользователя.\n"
-        "Ответь строго JSON. Для разных topic поля такие:\n"
-        "- PERSONAL_TASK/TEAM_TASK: title, description, due_datetime_local (ISO с учетом часового пояса пользователя),"
-        " priority (low|medium|high), tags (list[str]), assignees (list[str]) для командных задач.\n"
-        "- CALENDAR: summary, start_datetime_local, end_datetime_local, all_day (bool).\n"
-        "- PERSONAL_NOTE: title (может быть пустым), body.\n"
-        "Заполняй только актуальные для topic поля, остальные делай null или пустыми.\n"
-        "Используй CONTEXT для разрешения местоимений и ссылок на предыдущие действия.\n"
-        f"=== КОНТЕКСТ ===\n{context_text}\n"
-        f"INTENT (JSON): {json.dumps(intent, ensure_ascii=False)}\n"
-        f"=== ЗАПРОС ===\n{user_text}\n"
+def _store_intent_embedding(cache_key: str, intent: dict, scope: str, task: "asyncio.Task[Any]") -> None:
+    if task.cancelled() or task.exception() is not None or not task.result():
+        return
+    _intent_cache.add(cache_key, task.result(), intent, scope)
+
+
+async def _classify_intent(user_text: str, context_text: str) -> dict:
+    prompt = _build_prompt(context_text, user_text)
+    raw = await _call_model(
+        prompt,
+        temperature=0.1,
+        max_output_tokens=200,
+        extra_config={"response_schema": _INTENT_RESPONSE_SCHEMA},
+        json_mode=True,
+        system_instruction=_INTENT_INSTRUCTIONS,
     )
+    return _normalize_intent(_safe_json_loads(raw or ""))
+
+
+async def extract_structure(
+    profile: dict,
+    user_text: str,
+    context_text: str,
+    intent: dict | None = None,
+) -> dict:
+    """Извлекает структурированные данные в зависимости от темы.
+
+    intent необязателен: без него извлечение можно запускать параллельно с analyze_intent,
+    а тему модель определяет сама. С известной темой промт содержит только её поля.
+    """
+
+    intent_section = f"INTENT (JSON): {_prompt_json(intent)}\n" if intent else ""
+    topic = intent.get("topic") if intent else None
+    instructions = _EXTRACT_INSTRUCTIONS_BY_TOPIC.get(topic, _EXTRACT_INSTRUCTIONS)
+    schema = _EXTRACT_RESPONSE_SCHEMA_BY_TOPIC.get(topic, _EXTRACT_RESPONSE_SCHEMA)
+    prompt = _build_prompt(context_text, user_text, intent_section)
     try:
-        raw = await _call_model(prompt, temperature=0.2, max_output_tokens=400)
+        raw = await _call_model(
+            prompt,
+            temperature=0.2,
+            max_output_tokens=400,
+            extra_config={"response_schema": schema},
+            json_mode=True,
+            system_instruction=instructions,
+        )
         parsed = _safe_json_loads(raw or "") or {}
     except Exception:  # noqa: BLE001
         logger.warning("extract_structure failed, using defaults", exc_info=True)
         parsed = {}
 
-    tags = parsed.get("tags") if isinstance(parsed.get("tags"), list) else None
-    assignees = parsed.get("assignees") if isinstance(parsed.get("assignees"), list) else None
-
-    result: Dict[str, Any] = {
-        "title": parsed.get("title"),
-        "description": parsed.get("description"),
-        "due_datetime_local": parsed.get("due_datetime_local"),
-        "priority": parsed.get("priority"),
-        "tags": tags,
-        "assignees": assignees,
-        "summary": parsed.get("summary"),
-        "start_datetime_local": parsed.get("start_datetime_local"),
-        "end_datetime_local": parsed.get("end_datetime_local"),
-        "all_day": parsed.get("all_day"),
-        "body": parsed.get("body"),
-    }
-    return result
+    return _normalize_structure(parsed)
 
 
 async def make_plan(
@@ -446,99 +1737,150 @@ async def make_plan(
 ) -> dict:
     """Преобразует intent и структуру в исполняемый план."""
 
-    allowed_methods = [
-        "create_personal_task",
-        "update_personal_task",
-        "list_personal_tasks",
-        "create_team_task",
-        "update_team_task",
-        "list_team_tasks",
-        "create_or_update_calendar_event",
-        "show_calendar_agenda",
-        "write_personal_note",
-        "read_personal_notes",
-        "search_personal_notes",
-        "update_personal_note",
-        "delete_personal_note",
-        "chat",
-        "clarify",
-        "show_help",
-    ]
-
-    prompt = (
-        "Ты планировщик действий. На основе intent и извлечённых данных выбери метод и параметры.\n"
-        "Доступные методы: create_personal_task, update_personal_task, list_personal_tasks, create_team_task,"
-        " update_team_task, list_team_tasks, create_or_update_calendar_event, show_calendar_agenda, write_personal_note,"
-        " read_personal_notes, search_personal_notes, update_personal_note, delete_personal_note, chat, clarify, show_help.\n"
-        "Все задачи и заметки обязательно сохраняй в Google Sheets через соответствующие методы — таблицы уже созданы"
-        " (PersonalTasks, TeamTasks, PersonalNotes). Не отвечай, что нет таблицы: используй методы создания/обновления.\n"
-        "Если это просто разговор — method='chat'. Если данных недостаточно — method='clarify' и задай clarify_question.\n"
-        "Формат JSON ответа: {\"method\": string, \"params\": {...}, \"user_visible_answer\": string,"
-        " \"confidence\": 0..1, \"clarify_question\": null|string}.\n"
-        f"=== КОНТЕКСТ ===\n{context_text}\n"
-        f"INTENT:\n{json.dumps(intent, ensure_ascii=False)}\n"
-        f"STRUCTURED:\n{json.dumps(structured, ensure_ascii=False)}\n"
-        f"=== ЗАПРОС ===\n{user_text}\n"
-        "Отвечай только JSON."
+    cache_key = _plan_cache_key(profile, intent, structured)
+    if cache_key:
+        cached_plan = _plan_cache.get(cache_key)
+        if cached_plan is not None:
+            if _is_debug_enabled(profile):
+                logger.info("[debug] Plan taken from cache: %s", cached_plan)
+            return copy.deepcopy(cached_plan)
+
+    prompt = _build_prompt(
+        context_text,
+        user_text,
+        f"INTENT:\n{_prompt_json(intent)}\n",
+        f"STRUCTURED:\n{_prompt_json(structured)}\n",
+        suffix=_JSON_ONLY_SUFFIX,
     )
     fallback_plan = _clarify_plan(user_text)
-    raw = await _call_model(prompt, temperature=0.15, max_output_tokens=512)
+    raw = await _call_model(
+        prompt, temperature=0.15, max_output_tokens=512, json_mode=True, system_instruction=_PLAN_INSTRUCTIONS
+    )
 
     if _is_debug_enabled(profile):
         logger.info("[debug] Raw make_plan response: %s", raw)
 
-    parsed = _safe_json_loads(raw or "") or {}
-
-    if not raw or not parsed:
-        return fallback_plan
-
-    method_raw = parsed.get("method") if isinstance(parsed.get("method"), str) else None
-    method = method_raw if method_raw in allowed_methods else None
-    if not method:
+    plan = _normalize_plan(_safe_json_loads(raw or ""), user_text)
+    if plan is None:
         return fallback_plan
-    plan = {
-        "method": method,
-        "params": parsed.get("params") or {},
-        "user_visible_answer": parsed.get("user_visible_answer") or None,
-        "confidence": _coerce_confidence(parsed.get("confidence"), 0.5 if method == "chat" else 0.7),
-        "clarify_question": parsed.get("clarify_question"),
-    }
-    if method == "chat" and not plan["params"].get("question"):
-        plan["params"]["question"] = user_text
-    if method == "clarify" and not plan["clarify_question"]:
-        plan["clarify_question"] = "Мне нужно уточнить детали, чтобы продолжить."
 
     if _is_debug_enabled(profile):
         logger.info("[debug] Parsed plan: %s", plan)
 
+    if cache_key and plan["method"] not in {"chat", "clarify"}:
+        _plan_cache.set(cache_key, copy.deepcopy(plan))
+
     return plan
 
 
+def _skipped_review(intent: dict, plan: dict) -> dict:
+    quality = max(plan["confidence"], _coerce_confidence(intent.get("confidence"), 0.0))
+    return {"quality": quality, "problems": [], "clarify_question": None}
+
+
+async def make_plan_and_review(
+    profile: dict,
+    user_text: str,
+    context_text: str,
+    intent: dict,
+    structured: dict,
+) -> tuple[dict, dict]:
+    """Строит план и его ревью одним вызовом модели.
+
+    Если план взят из кеша или в ответе нет одной из частей, используются make_plan и review_plan.
+    """
+
+    cache_key = _plan_cache_key(profile, intent, structured)
+    cached_plan = _plan_cache.get(cache_key) if cache_key else None
+    plan = copy.deepcopy(cached_plan) if cached_plan is not None else None
+    review = None
+    if plan is None:
+        prompt = _build_prompt(
+            context_text,
+            user_text,
+            f"INTENT:\n{_prompt_json(intent)}\n",
+            f"STRUCTURED:\n{_prompt_json(structured)}\n",
+            suffix=_JSON_ONLY_SUFFIX,
+        )
+        raw = await _call_model(
+            prompt,
+            temperature=0.15,
+            max_output_tokens=768,
+            json_mode=True,
+            system_instruction=_PLAN_REVIEW_INSTRUCTIONS,
+        )
+
+        if _is_debug_enabled(profile):
+            logger.info("[debug] Raw make_plan_and_review response: %s", raw)
+
+        parsed = _safe_json_loads(raw or "")
+        if (
+            isinstance(parsed, dict)
+            and isinstance(parsed.get("plan"), dict)
+            and isinstance(parsed.get("review"), dict)
+        ):
+            plan = _normalize_plan(parsed["plan"], user_text)
+            review = _normalize_review(parsed["review"])
+        if plan is None:
+            logger.info("make_plan_and_review response was not parsed, falling back to make_plan and review_plan")
+        elif cache_key and plan["method"] not in {"chat", "clarify"}:
+            _plan_cache.set(cache_key, copy.deepcopy(plan))
+
+    if plan is None:
+        plan = await make_plan(profile, user_text, context_text, intent, structured)
+    skip_review = _can_skip_review(intent, plan)
+    _prepare_plan(plan, structured, user_text)
+    if skip_review:
+        review = _skipped_review(intent, plan)
+    elif review is None:
+        review = await review_plan(profile, user_text, context_text, plan)
+    return plan, review
+
+
 async def review_plan(profile: dict, user_text: str, context_text: str, plan: dict) -> dict:
     """Оценивает качество плана и необходимость уточнений."""
 
-    prompt = (
-        "Ты ревизор плана. Проверь, хватает ли данных в plan.params для безопасного выполнения."
-        " Оцени дату/время, полноту описания и соответствие intent выбранному методу.\n"
-        "Верни JSON {\"quality\":0..1, \"problems\":[...], \"clarify_question\": null|string}.\n"
-        "Если есть сомнения — предлагай уточнить.\n"
-        f"=== КОНТЕКСТ ===\n{context_text}\n"
-        f"PLAN:\n{json.dumps(plan, ensure_ascii=False)}\n"
-        f"=== ЗАПРОС ===\n{user_text}\n"
-        "Отвечай только JSON."
+    prompt = _build_prompt(context_text, user_text, f"PLAN:\n{_prompt_json(plan)}\n")
+    raw = await _call_model(
+        prompt,
+        temperature=0.1,
+        max_output_tokens=256,
+        extra_config={"response_schema": _REVIEW_RESPONSE_SCHEMA},
+        json_mode=True,
+        system_instruction=_REVIEW_INSTRUCTIONS,
+    )
+    return _normalize_review(_safe_json_loads(raw or ""))
+
+
+async def analyze_and_plan(profile: dict, user_text: str, context_text: str) -> Optional[dict]:
+    """Выполняет классификацию, извлечение, планирование и ревью одним вызовом модели.
+
+    Возвращает {"intent", "structured", "plan", "review"} или None, если ответ не удалось разобрать.
+    """
+
+    prompt = _build_prompt(context_text, user_text, suffix=_JSON_ONLY_SUFFIX)
+    raw = await _call_model(
+        prompt, temperature=0.15, max_output_tokens=900, json_mode=True, system_instruction=_FUSED_INSTRUCTIONS
     )
-    raw = await _call_model(prompt, temperature=0.1, max_output_tokens=256)
+
+    if _is_debug_enabled(profile):
+        logger.info("[debug] Raw analyze_and_plan response: %s", raw)
+
     parsed = _safe_json_loads(raw or "")
-    if not parsed:
-        return {
-            "quality": 0.5,
-            "problems": [],
-            "clarify_question": None,
-        }
+    if not isinstance(parsed, dict):
+        return None
+    stages = {name: parsed.get(name) for name in ("intent", "structured", "plan", "review")}
+    if not all(isinstance(value, dict) for value in stages.values()):
+        return None
+
+    plan = _normalize_plan(stages["plan"], user_text)
+    if plan is None:
+        return None
     return {
-        "quality": _coerce_confidence(parsed.get("quality"), 0.5),
-        "problems": parsed.get("problems") or [],
-        "clarify_question": parsed.get("clarify_question"),
+        "intent": _normalize_intent(stages["intent"]),
+        "structured": _normalize_structure(stages["structured"]),
+        "plan": plan,
+        "review": _normalize_review(stages["review"]),
     }
 
 
@@ -546,92 +1888,226 @@ async def free_chat(
     profile: dict,
     question: str | None = None,
     context_text: str | None = None,
+    on_chunk: Optional[ChunkCallback] = None,
     **kwargs: Any,
 ) -> str:
-    """Свободный диалог с учётом контекста и безопасным фолбэком."""
+    """Свободный диалог с учётом контекста и безопасным фолбэком.
+
+    Если передан on_chunk, ответ читается потоком и показывается по мере генерации.
+    """
 
     resolved_question = question or "Продолжай диалог со мной."
     resolved_context = truncate_text(
         context_text or await build_context_for_user(profile), 2500
     )
-    prompt = (
-        "Ты — дружелюбный ассистент. Отвечай кратко и по делу на русском языке. "
-        "Используй контекст только если он действительно нужен.\n"
-        f"Контекст:\n{resolved_context}\n"
-        f"Запрос: {resolved_question}\n"
-    )
-    text = await _call_model(
-        prompt,
-        temperature=0.3,
-        max_output_tokens=400,
-        extra_config=kwargs.get("extra_config"),
-        retry_without_context=True,
-    )
+    prompt = _FREE_CHAT_TEMPLATE.format_map({"context": resolved_context, "question": resolved_question})
+    text = None
+    if on_chunk is not None:
+        text = await _stream_text(
+            prompt, on_chunk, temperature=0.3, max_output_tokens=400, extra_config=kwargs.get("extra_config")
+        )
+    if not text:
+        text = await _call_model(
+            prompt,
+            temperature=0.3,
+            max_output_tokens=400,
+            extra_config=kwargs.get("extra_config"),
+            retry_without_context=True,
+        )
     return text or (
         "Сейчас у меня не получается получить ответ от модели, но я продолжу помогать с задачами и "
         "напоминаниями. Попробуйте переформулировать вопрос проще."
     )
 
 
-async def process_user_request(profile: dict, user_text: str) -> dict:
-    """Оркеструет все этапы AI и возвращает итоговый план."""
+def _chat_plan(user_text: str, context_text: str, reply: str) -> dict:
+    return {
+        "method": "chat",
+        "params": {"question": user_text, "context_text": context_text},
+        "user_visible_answer": reply,
+        "confidence": 1.0,
+        "clarify_question": None,
+        "original_question": user_text,
+    }
+
 
-    fallback_plan = _clarify_plan(user_text)
+def _prepare_plan(plan: dict, structured: dict, user_text: str) -> None:
+    plan.setdefault("params", {})
+    _ensure_task_deadline_for_calendar(plan, structured)
+    plan["original_question"] = user_text
 
-    try:
-        context_text = await build_context_for_user(profile)
+
+def _finalize_plan(user_text: str, context_text: str, intent: dict, plan: dict, review: dict) -> dict:
+    """Применяет пороги уверенности и ревью к плану и возвращает итоговый план."""
+
+    quality = review.get("quality", 0.0)
+    clarify_question = review.get("clarify_question")
+
+    if (
+        _coerce_confidence(intent.get("confidence"), 0.0) < 0.3
+        or not plan.get("method")
+        or _coerce_confidence(quality, 0.0) < 0.3
+    ):
+        return _clarify_plan(user_text)
+
+    if quality < 0.5:
+        return {
+            "method": "clarify",
+            "params": {},
+            "user_visible_answer": clarify_question
+            or "Я не уверен, что правильно понял запрос. Уточните, пожалуйста.",
+            "confidence": quality,
+            "clarify_question": clarify_question,
+            "original_question": user_text,
+        }
+
+    if 0.5 <= quality < 0.8 and clarify_question:
+        return {
+            "method": "clarify",
+            "params": {},
+            "user_visible_answer": clarify_question,
+            "confidence": quality,
+            "clarify_question": clarify_question,
+            "original_question": user_text,
+        }
+
+    if plan.get("method") == "chat":
+        # chat_handler получит уже собранный контекст и не станет строить его заново
+        plan["params"].setdefault("context_text", context_text)
+    return plan
+
+
+def _can_skip_review(intent: dict, plan: dict) -> bool:
+    """Ревью не нужно для простых неразрушающих запросов, если intent и план уверенные, а план с параметрами.
+
+    Методы без параметров для проверки (чат, справка, уточнение) не проверяются при уверенном intent.
+    """
+
+    if plan.get("method") in _NO_PARAMS_METHODS:
+        return _coerce_confidence(intent.get("confidence"), 0.0) >= _SKIP_REVIEW_TRIVIAL_CONFIDENCE
+    return (
+        intent.get("complexity") == "simple"
+        and intent.get("intent") in _REVIEW_OPTIONAL_INTENTS
+        and _coerce_confidence(intent.get("confidence"), 0.0) >= CONFIG.ai_high_confidence
+        and _coerce_confidence(plan.get("confidence"), 0.0) >= _SKIP_REVIEW_CONFIDENCE
+        and bool(plan.get("params"))
+    )
+
+
+class _ChunkGate:
+    """Придерживает потоковый текст спекулятивного ответа, пока не решено, что он нужен пользователю."""
+
+    __slots__ = ("_target", "_latest", "_open")
+
+    def __init__(self, target: ChunkCallback) -> None:
+        self._target = target
+        self._latest = ""
+        self._open = False
+
+    async def update(self, text: str) -> None:
+        self._latest = text
+        if self._open:
+            await self._target(text)
+
+    async def open(self) -> None:
+        """Начинает пересылать текст; уже накопленная часть показывается сразу."""
+
+        self._open = True
+        if not self._latest:
+            return
+        try:
+            await self._target(self._latest)
+        except Exception:  # noqa: BLE001
+            logger.warning("Не удалось показать промежуточный ответ модели", exc_info=True)
+
+
+async def _process_multi_stage(
+    profile: dict, user_text: str, context_text: str, on_chunk: Optional[ChunkCallback] = None
+) -> dict:
+    """Поэтапный конвейер: отдельные вызовы модели для intent и структуры, план и ревью — одним вызовом."""
+
+    # Извлечение структуры не ждёт analyze_intent: запускаем параллельно, а если тема однозначна
+    # по ключевым словам, сразу передаём её, чтобы промт содержал только нужные поля
+    canonical_text = canonicalize_text(user_text)
+    topic_hint = _heuristic_intent(canonical_text)
+    # TaskGroup отменяет фоновые этапы, если analyze_intent или ожидание прервутся исключением
+    # или отменой, и не выпускает из блока незавершённые задачи
+    async with asyncio.TaskGroup() as tg:
+        structured_task = tg.create_task(extract_structure(profile, user_text, context_text, topic_hint))
+        # Ответ для свободного диалога готовим заранее, пока определяется intent, но только если запрос
+        # похож на разговор: при упоминании задач, заметок, календаря или действий над ними
+        # спекулятивный вызов почти всегда выбрасывается и лишь расходует квоту
+        # Спекулятивный ответ читается потоком, но пользователю показывается только после того,
+        # как intent подтвердит разговор
+        chat_gate = _ChunkGate(on_chunk) if on_chunk is not None else None
+        chat_task = (
+            tg.create_task(
+                free_chat(
+                    profile,
+                    question=user_text,
+                    context_text=context_text,
+                    on_chunk=chat_gate.update if chat_gate is not None else None,
+                )
+            )
+            if not _mentions_actions(canonical_text)
+            else None
+        )
         intent = await analyze_intent(profile, user_text, context_text)
 
         if intent.get("topic") == "CHAT":
-            reply = await free_chat(profile, question=user_text, context_text=context_text)
-            return {
-                "method": "chat",
-                "params": {"question": user_text, "context_text": context_text},
-                "user_visible_answer": reply,
-                "confidence": 1.0,
-                "clarify_question": None,
-                "original_question": user_text,
-            }
-
-        structured = await extract_structure(profile, user_text, context_text, intent)
-        plan = await make_plan(profile, user_text, context_text, intent, structured)
-        plan.setdefault("params", {})
-        _ensure_task_deadline_for_calendar(plan, structured)
-        plan["original_question"] = user_text
-        review = await review_plan(profile, user_text, context_text, plan)
+            structured_task.cancel()
+            if chat_task is not None:
+                if chat_gate is not None:
+                    await chat_gate.open()
+                reply = await chat_task
+            else:
+                reply = await free_chat(profile, question=user_text, context_text=context_text, on_chunk=on_chunk)
+            return _chat_plan(user_text, context_text, reply)
+        if chat_task is not None:
+            chat_task.cancel()
+
+        # Извлечение шло параллельно с analyze_intent; план строится по его полям (название, приоритет,
+        # исполнители), а не только по intent, — иначе они теряются и ключ кэша плана всегда пуст
+        structured = await structured_task
+        plan, review = await make_plan_and_review(profile, user_text, context_text, intent, structured)
+    return _finalize_plan(user_text, context_text, intent, plan, review)
+
+
+async def process_user_request(
+    profile: dict, user_text: str, on_chunk: Optional[ChunkCallback] = None
+) -> dict:
+    """Оркеструет все этапы AI и возвращает итоговый план.
+
+    По умолчанию все этапы выполняются одним вызовом модели (analyze_and_plan); поэтапный
+    конвейер используется при CONFIG.ai_multi_stage или если объединённый ответ не разобран.
+    on_chunk получает текст ответа свободного диалога по мере генерации.
+    """
 
-        quality = review.get("quality", 0.0)
-        clarify_question = review.get("clarify_question")
+    fallback_plan = _clarify_plan(user_text)
 
-        if (
-            _coerce_confidence(intent.get("confidence"), 0.0) < 0.3
-            or not plan.get("method")
-            or _coerce_confidence(quality, 0.0) < 0.3
-        ):
-            return fallback_plan
-
-        if quality < 0.5:
-            return {
-                "method": "clarify",
-                "params": {},
-                "user_visible_answer": clarify_question
-                or "Я не уверен, что правильно понял запрос. Уточните, пожалуйста.",
-                "confidence": quality,
-                "clarify_question": clarify_question,
-                "original_question": user_text,
-            }
-
-        if 0.5 <= quality < 0.8 and clarify_question:
-            return {
-                "method": "clarify",
-                "params": {},
-                "user_visible_answer": clarify_question,
-                "confidence": quality,
-                "clarify_question": clarify_question,
-                "original_question": user_text,
-            }
-
-        return plan
+    small_talk = _small_talk_reply(canonicalize_text(user_text))
+    if small_talk is not None:
+        return _chat_plan(user_text, "", small_talk)
+
+    try:
+        context_text = await build_context_for_user(profile)
+
+        if not CONFIG.ai_multi_stage:
+            fused = await analyze_and_plan(profile, user_text, context_text)
+            if fused is not None:
+                intent, plan = fused["intent"], fused["plan"]
+                if intent.get("topic") == "CHAT":
+                    reply = plan.get("user_visible_answer") if plan["method"] == "chat" else None
+                    if not reply:
+                        reply = await free_chat(
+                            profile, question=user_text, context_text=context_text, on_chunk=on_chunk
+                        )
+                    return _chat_plan(user_text, context_text, reply)
+                _prepare_plan(plan, fused["structured"], user_text)
+                return _finalize_plan(user_text, context_text, intent, plan, fused["review"])
+            logger.info("analyze_and_plan response was not parsed, falling back to multi-stage pipeline")
+
+        return await _process_multi_stage(profile, user_text, context_text, on_chunk)
     except Exception:  # noqa: BLE001
         logger.exception("Ошибка в process_user_request")
         return fallback_plan
@@ -640,62 +2116,125 @@ async def process_user_request(profile: dict, user_text: str) -> dict:
 async def build_reminder_text(tasks: list[dict], user: dict) -> str:
     """Формирует текст напоминания с использованием модели и безопасным фолбэком."""
 
-    user_name = user.get("display_name") or user.get("telegram_full_name") or "Коллега"
+    user_name = _reminder_user_name(user)
 
-    prompt = f"""
-Ты — персональный ассистент и секретарь.
+    prompt = _REMINDER_TEMPLATE.format_map({"user_name": user_name, "tasks": _format_tasks_for_prompt(tasks)})
 
-Пользователь: {user_name}
-Нужно составить краткое напоминание о его задачах.
+    text = await _call_model(prompt, temperature=0.2, max_output_tokens=300)
 
-Список задач:
-{_format_tasks_for_prompt(tasks)}
+    if text:
+        return text.strip()
+    return _reminder_fallback_text(tasks, user)
 
-Сделай:
 
-вежливое обращение к пользователю по имени;
+def _reminder_fallback_text(tasks: list[dict], user: dict) -> str:
+    """Напоминание без модели: обращение и список задач."""
 
-короткий текст напоминания;
+    header = f"{_reminder_user_name(user)}, напоминаю о ваших задачах:"
+    if not tasks:
+        return f"{header}\nНа данный момент у вас нет активных задач."
 
-перечисли задачи по пунктам.
+    return "\n".join([header, *[_reminder_line(idx, task) for idx, task in enumerate(tasks, start=1)]])
 
-Ответ отдай одним цельным текстом на русском языке.
-""".strip()
 
-    text = await _call_model(prompt, temperature=0.2, max_output_tokens=300)
+async def build_reminder_texts(batch: list[tuple[dict, list[dict]]]) -> list[str]:
+    """Формирует напоминания для списка (пользователь, задачи), объединяя пользователей в пакеты.
 
-    if text:
-        return text.strip()
+    На каждые _REMINDER_BATCH_SIZE пользователей уходит один вызов модели; если пакетный вызов
+    упал или ответ не разобран, тексты пакета строятся по одному через build_reminder_text.
+    Ошибка одного пакета или пользователя не лишает напоминаний остальных.
+    """
 
-    lines: list[str] = []
-    lines.append(f"{user_name}, напоминаю о ваших задачах:")
+    chunks = [batch[start : start + _REMINDER_BATCH_SIZE] for start in range(0, len(batch), _REMINDER_BATCH_SIZE)]
+    results = await asyncio.gather(*[_build_reminder_batch(chunk) for chunk in chunks], return_exceptions=True)
+    texts: list[str] = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            logger.warning(
+                "Batched reminder generation failed, building %s reminders one by one", len(chunk), exc_info=result
+            )
+            result = await _build_reminders_one_by_one(chunk)
+        texts.extend(result)
+    return texts
 
-    if not tasks:
-        lines.append("На данный момент у вас нет активных задач.")
-        return "\n".join(lines)
-
-    for idx, task in enumerate(tasks, start=1):
-        title = task.get("title") or task.get("name") or "Задача без названия"
-        due = task.get("due") or task.get("due_datetime_local") or task.get("due_datetime") or ""
-        if due:
-            lines.append(f"{idx}) {title} — срок: {due}")
-        else:
-            lines.append(f"{idx}) {title}")
 
-    return "\n".join(lines)
+async def _build_reminder_batch(chunk: list[tuple[dict, list[dict]]]) -> list[str]:
+    users = [
+        {"user": _reminder_user_name(user), "tasks": _format_tasks_for_prompt(tasks)} for user, tasks in chunk
+    ]
+    prompt = _REMINDER_BATCH_TEMPLATE.format_map({"users": _prompt_json(users)})
+    raw = await _call_model(
+        prompt,
+        temperature=0.2,
+        max_output_tokens=300 * len(chunk),
+        extra_config={"response_schema": _REMINDER_BATCH_SCHEMA},
+        json_mode=True,
+    )
+    reminders = (_safe_json_loads(raw or "") or {}).get("reminders")
+    if (
+        isinstance(reminders, list)
+        and len(reminders) == len(chunk)
+        and all(isinstance(text, str) and text.strip() for text in reminders)
+    ):
+        return [text.strip() for text in reminders]
+    logger.info("Batched reminder response was not parsed, building %s reminders one by one", len(chunk))
+    return await _build_reminders_one_by_one(chunk)
+
+
+async def _build_reminders_one_by_one(chunk: list[tuple[dict, list[dict]]]) -> list[str]:
+    results = await asyncio.gather(
+        *[build_reminder_text(tasks, user) for user, tasks in chunk], return_exceptions=True
+    )
+    texts: list[str] = []
+    for (user, tasks), result in zip(chunk, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            logger.warning("Reminder generation failed for user_id=%s", user.get("user_id"), exc_info=result)
+            result = _reminder_fallback_text(tasks, user)
+        texts.append(result)
+    return texts
+
+
+def _reminder_user_name(user: dict) -> str:
+    return user.get("display_name") or user.get("telegram_full_name") or "Коллега"
+
+
+# В промт напоминания попадают не больше стольких задач: сначала просроченные, затем по приоритету и сроку
+_PROMPT_TASK_LIMIT = 10
+_PRIORITY_RANK = {"high": 0, "medium": 1, "low": 2}
+
+
+def _task_urgency(task: dict) -> tuple:
+    priority = str(task.get("priority") or "").strip().lower()
+    return not task.get("is_overdue"), _PRIORITY_RANK.get(priority, 1), _task_due(task) or "~"
 
 
 def _format_tasks_for_prompt(tasks: list[dict]) -> str:
-    """Подготавливает список задач для передачи в промт модели."""
+    """Подготавливает список задач для передачи в промт модели: по строке на самые срочные задачи."""
 
     if not tasks:
         return "Нет активных задач."
 
-    lines: list[str] = []
-    for idx, task in enumerate(tasks[:10], start=1):
-        title = task.get("title") or task.get("name") or "Задача без названия"
-        due = task.get("due") or task.get("due_datetime_local") or task.get("due_datetime") or "срок не указан"
-        status = task.get("status") or "open"
-        lines.append(f"{idx}) [{status}] {title} (срок: {due})")
+    return "\n".join(
+        [
+            f"{idx}) [{task.get('status') or 'open'}] {_task_title(task)}"
+            f" (срок: {_task_due(task) or 'срок не указан'}{', просрочена' if task.get('is_overdue') else ''})"
+            for idx, task in enumerate(heapq.nsmallest(_PROMPT_TASK_LIMIT, tasks, key=_task_urgency), start=1)
+        ]
+    )
+
+
+def _reminder_line(idx: int, task: dict) -> str:
+    due = _task_due(task)
+    return f"{idx}) {_task_title(task)} — срок: {due}" if due else f"{idx}) {_task_title(task)}"
+
+
+def _task_title(task: dict) -> str:
+    return task.get("title") or task.get("name") or "Задача без названия"
+
 
-    return "\n".join(lines)
+def _task_due(task: dict) -> str:
+    return task.get("due") or task.get("due_datetime_local") or task.get("due_datetime") or ""
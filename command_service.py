@@ -2,9 +2,12 @@
 from __future__ import annotations
 
 import asyncio
+import contextvars
+import functools
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, Optional, Tuple
 
 from ai_service import free_chat
 import ai_service
@@ -30,8 +33,14 @@ class CommandResult:
     extra_data: Optional[dict] = None
 
 
+# Обработчики команд (Google Sheets/Calendar) работают в собственном ограниченном пуле потоков,
+# чтобы всплеск команд не занимал потоки, общие для остальных asyncio.to_thread
+_google_io_executor = ThreadPoolExecutor(max_workers=CONFIG.io_thread_pool_size, thread_name_prefix="google-io")
+
+
 async def _run_sync(func: Callable, *args, **kwargs):
-    return await asyncio.to_thread(func, *args, **kwargs)
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_google_io_executor, call)
 
 
 async def chat_handler(
@@ -44,42 +53,54 @@ async def chat_handler(
     return text
 
 
-METHOD_MAP: Dict[str, Callable] = {
-    "write_personal_note": google_service.create_personal_note,
-    "read_personal_notes": google_service.read_personal_notes,
-    "search_personal_notes": google_service.search_personal_notes,
-    "update_personal_note": google_service.update_personal_note,
-    "delete_personal_note": google_service.delete_personal_note,
-    "create_personal_task": google_service.create_personal_task,
-    "update_personal_task": google_service.update_personal_task,
-    "list_personal_tasks": google_service.list_personal_tasks,
-    "create_team_task": google_service.create_team_task,
-    "update_team_task": google_service.update_team_task,
-    "list_team_tasks": google_service.list_team_tasks,
-    "create_or_update_calendar_event": google_service.create_or_update_event,
-    "show_calendar_agenda": google_service.show_calendar_agenda,
-    "show_help": debug_service.default_help,
-    "debug_on": debug_service.debug_on,
-    "debug_off": debug_service.debug_off,
-    "debug_status": debug_service.debug_status,
-    "debug_create_test_event": debug_service.create_test_calendar_event,
-    "debug_show_today_agenda": debug_service.show_today_agenda,
-    "chat": chat_handler,
+# Для каждого метода заранее вычисляется, корутина ли обработчик, чтобы не проверять это при каждом вызове
+METHOD_MAP: Dict[str, Tuple[Callable, bool]] = {
+    name: (handler, asyncio.iscoroutinefunction(handler))
+    for name, handler in {
+        "write_personal_note": google_service.create_personal_note,
+        "read_personal_notes": google_service.read_personal_notes,
+        "search_personal_notes": google_service.search_personal_notes,
+        "update_personal_note": google_service.update_personal_note,
+        "delete_personal_note": google_service.delete_personal_note,
+        "create_personal_task": google_service.create_personal_task,
+        "update_personal_task": google_service.update_personal_task,
+        "list_personal_tasks": google_service.list_personal_tasks,
+        "create_team_task": google_service.create_team_task,
+        "update_team_task": google_service.update_team_task,
+        "list_team_tasks": google_service.list_team_tasks,
+        "create_or_update_calendar_event": google_service.create_or_update_event,
+        "show_calendar_agenda": google_service.show_calendar_agenda,
+        "show_help": debug_service.default_help,
+        "debug_on": debug_service.debug_on,
+        "debug_off": debug_service.debug_off,
+        "debug_status": debug_service.debug_status,
+        "debug_create_test_event": debug_service.create_test_calendar_event,
+        "debug_show_today_agenda": debug_service.show_today_agenda,
+        "chat": chat_handler,
+    }.items()
+}
+
+# Каждый метод, который планировщик может вернуть, должен иметь обработчик, иначе запрос молча
+# уйдёт в чат; clarify обрабатывается в execute_plan до поиска обработчика
+_UNHANDLED_METHODS = ai_service._ALLOWED_METHODS - METHOD_MAP.keys() - {"clarify"}
+if _UNHANDLED_METHODS:
+    raise RuntimeError(f"METHOD_MAP has no handlers for AI methods: {sorted(_UNHANDLED_METHODS)}")
+
+
+_ACTION_TYPE_MAP: Dict[str, str] = {
+    "create_personal_task": "TASK_CREATED",
+    "update_personal_task": "TASK_UPDATED",
+    "create_team_task": "TASK_CREATED",
+    "update_team_task": "TASK_UPDATED",
+    "create_or_update_calendar_event": "CALENDAR_EVENT_CREATED",
+    "write_personal_note": "NOTE_CREATED",
+    "update_personal_note": "NOTE_UPDATED",
+    "delete_personal_note": "NOTE_DELETED",
 }
 
 
 def _log_action_safe(profile: dict, method: str, params: dict) -> None:
-    action_type_map = {
-        "create_personal_task": "TASK_CREATED",
-        "update_personal_task": "TASK_UPDATED",
-        "create_team_task": "TASK_CREATED",
-        "update_team_task": "TASK_UPDATED",
-        "create_or_update_calendar_event": "CALENDAR_EVENT_CREATED",
-        "write_personal_note": "NOTE_CREATED",
-        "update_personal_note": "NOTE_UPDATED",
-        "delete_personal_note": "NOTE_DELETED",
-    }
-    action_type = action_type_map.get(method)
+    action_type = _ACTION_TYPE_MAP.get(method)
     if not action_type:
         return
     try:
@@ -126,7 +147,7 @@ async def execute_plan(profile: dict, plan: dict) -> CommandResult:
         if debug_enabled and debug_user_id is not None:
             debug_info = (
                 f"\n\n[debug] method={method}; confidence={confidence:.2f}; "
-                f"params_keys={list((plan.get('params') or {}).keys())}"
+                f"params_keys={list(params)}"
             )
             command_result.user_visible_answer = (command_result.user_visible_answer or "") + debug_info
 
@@ -138,9 +159,9 @@ async def execute_plan(profile: dict, plan: dict) -> CommandResult:
         fallback_text = "Я не уверен, что правильно понял запрос. Уточните, пожалуйста."
         return CommandResult(user_visible_answer=str(question_text or fallback_text))
 
-    handler = METHOD_MAP.get(method)
+    handler, is_coroutine = METHOD_MAP.get(method, (None, False))
     if handler is None:
-        handler = chat_handler
+        handler, is_coroutine = chat_handler, True
         params = {
             "question": params.get("question") or plan.get("user_visible_answer") or plan.get("original_question") or "",
             "context_text": params.get("context_text")
@@ -148,7 +169,7 @@ async def execute_plan(profile: dict, plan: dict) -> CommandResult:
         }
 
     try:
-        if asyncio.iscoroutinefunction(handler):
+        if is_coroutine:
             result = await handler(profile, **params)
         else:
             result = await _run_sync(handler, profile, **params)
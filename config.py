@@ -7,8 +7,9 @@ working directory may differ.
 """
 from __future__ import annotations
 
+import json
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
@@ -18,6 +19,16 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def _parse_list(value: Optional[str]) -> tuple[str, ...]:
+    """Parse a JSON list or a comma-separated string into a tuple of non-empty items."""
+
+    if not value:
+        return ()
+    value = value.strip()
+    items = json.loads(value) if value.startswith("[") else value.split(",")
+    return tuple(str(item).strip() for item in items if str(item).strip())
+
+
 @dataclass(frozen=True)
 class Config:
     """Global configuration loaded from environment variables."""
@@ -34,9 +45,24 @@ class Config:
     yandex_calendar_name: Optional[str]
     dialog_log_path: Path
     ai_model: str
+    ai_model_fallbacks: tuple[str, ...] = ()
+    genai_api_key: Optional[str] = field(default=None, repr=False)
+    genai_api_keys: tuple[str, ...] = field(default=(), repr=False)
     ai_high_confidence: float = 0.75
     ai_low_confidence: float = 0.40
     reminder_interval_seconds: int = 300
+    ai_cache_size: int = 256
+    ai_cache_ttl_seconds: int = 600
+    ai_cache_max_temperature: float = 0.2
+    ai_semantic_cache: bool = True
+    ai_semantic_threshold: float = 0.92
+    ai_embedding_model: str = "models/text-embedding-004"
+    ai_multi_stage: bool = False
+    ai_context_cache_ttl_seconds: int = 30
+    ai_concurrency: int = 16
+    ai_cache_path: Optional[Path] = None
+    io_thread_pool_size: int = 8
+    ai_key_cooldown_seconds: int = 60
 
     @property
     def AI_MODEL(self) -> str:
@@ -62,7 +88,25 @@ class Config:
         project_root = Path(__file__).resolve().parent
         log_path = Path(os.getenv("DIALOG_LOG_PATH", project_root / "dialog_log.jsonl")).resolve()
         ai_model = os.getenv("GENAI_MODEL", "gemini-2.5-flash")
+        ai_model_fallbacks = _parse_list(os.getenv("GENAI_MODEL_FALLBACKS"))
+        # GOOGLE_API_KEYS is a pool of keys rotated per call; the first one is the default key
+        genai_api_keys = _parse_list(os.getenv("GOOGLE_API_KEYS")) or _parse_list(
+            os.getenv("GOOGLE_API_KEY") or os.getenv("GENAI_API_KEY")
+        )
+        genai_api_key = genai_api_keys[0] if genai_api_keys else None
         reminder_interval = int(os.getenv("REMINDER_INTERVAL_SECONDS", "300"))
+        ai_cache_size = int(os.getenv("AI_CACHE_SIZE", "256"))
+        ai_cache_ttl = int(os.getenv("AI_CACHE_TTL_SECONDS", "600"))
+        ai_cache_max_temperature = float(os.getenv("AI_CACHE_MAX_TEMPERATURE", "0.2"))
+        ai_semantic_cache = os.getenv("AI_SEMANTIC_CACHE", "true").lower() in {"1", "true", "yes"}
+        ai_semantic_threshold = float(os.getenv("AI_SEMANTIC_THRESHOLD", "0.92"))
+        ai_embedding_model = os.getenv("GENAI_EMBEDDING_MODEL", "models/text-embedding-004")
+        ai_multi_stage = os.getenv("AI_MULTI_STAGE", "false").lower() in {"1", "true", "yes"}
+        ai_context_cache_ttl = int(os.getenv("AI_CONTEXT_CACHE_TTL_SECONDS", "30"))
+        ai_concurrency = int(os.getenv("AI_CONCURRENCY", "16"))
+        ai_cache_path = os.getenv("AI_CACHE_PATH")
+        io_thread_pool_size = int(os.getenv("IO_THREAD_POOL_SIZE", "8"))
+        ai_key_cooldown = int(os.getenv("AI_KEY_COOLDOWN_SECONDS", "60"))
         return Config(
             telegram_token=token,
             google_project_id=os.getenv("GOOGLE_PROJECT_ID"),
@@ -76,7 +120,22 @@ class Config:
             yandex_calendar_name=yandex_calendar_name,
             dialog_log_path=log_path,
             ai_model=ai_model,
+            ai_model_fallbacks=ai_model_fallbacks,
+            genai_api_key=genai_api_key,
+            genai_api_keys=genai_api_keys,
             reminder_interval_seconds=reminder_interval,
+            ai_cache_size=ai_cache_size,
+            ai_cache_ttl_seconds=ai_cache_ttl,
+            ai_cache_max_temperature=ai_cache_max_temperature,
+            ai_semantic_cache=ai_semantic_cache,
+            ai_semantic_threshold=ai_semantic_threshold,
+            ai_embedding_model=ai_embedding_model,
+            ai_multi_stage=ai_multi_stage,
+            ai_context_cache_ttl_seconds=ai_context_cache_ttl,
+            ai_concurrency=ai_concurrency,
+            ai_cache_path=Path(ai_cache_path).resolve() if ai_cache_path else None,
+            io_thread_pool_size=io_thread_pool_size,
+            ai_key_cooldown_seconds=ai_key_cooldown,
         )
 
 
@@ -5,6 +5,7 @@ from collections import defaultdict, deque
 from typing import Deque, Dict, List
 
 _HISTORY: Dict[int, Deque[dict]] = defaultdict(lambda: deque(maxlen=50))
+_VERSIONS: Dict[int, int] = {}
 
 
 def append_message(user_id: int, role: str, text: str) -> None:
@@ -12,6 +13,12 @@ def append_message(user_id: int, role: str, text: str) -> None:
     if role not in {"user", "assistant"}:
         return
     _HISTORY[user_id].append({"role": role, "text": text})
+    _VERSIONS[user_id] = _VERSIONS.get(user_id, 0) + 1
+
+
+def get_history_version(user_id: int) -> int:
+    """Return a counter that changes whenever the user's history changes."""
+    return _VERSIONS.get(user_id, 0)
 
 
 def get_recent_history(user_id: int, limit: int = 8) -> List[dict]:
@@ -5,6 +5,11 @@ import json
 from pathlib import Path
 from typing import Any, Dict
 
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib json is used otherwise
+    orjson = None
+
 from config import CONFIG
 
 
@@ -14,8 +19,12 @@ class DialogLogger:
 
     def log(self, record: Dict[str, Any]) -> None:
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        with self.path.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if orjson is not None:
+            line = orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        else:
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.path.open("ab") as f:
+            f.write(line)
 
 
 dialog_logger = DialogLogger(CONFIG.dialog_log_path)
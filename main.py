@@ -3,8 +3,10 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import time
 from datetime import datetime
 from pathlib import Path
+from typing import Awaitable, Callable, Optional
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode
@@ -42,6 +44,49 @@ def _safe_append_dialog(profile: dict, role: str, text: str) -> None:
         logger.debug("Failed to append dialog message", exc_info=True)
 
 
+async def _update_last_seen_safe(user_id: int) -> None:
+    try:
+        await asyncio.to_thread(google_service.update_last_seen, user_id)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Failed to update last_seen for user_id=%s: %s", user_id, exc)
+
+
+# Telegram ограничивает частоту правок сообщения, поэтому промежуточный текст обновляем не чаще этого
+_STREAM_EDIT_INTERVAL_SECONDS = 1.0
+
+
+class _StreamingReply:
+    """Показывает ответ по мере генерации: первый фрагмент отправляется, дальше сообщение редактируется."""
+
+    def __init__(self, send: Callable[[str], Awaitable[Message]]) -> None:
+        self._send = send
+        self._sent: Optional[Message] = None
+        self._shown = ""
+        self._last_update = 0.0
+
+    async def update(self, text: str) -> None:
+        if self._sent is not None and time.monotonic() - self._last_update < _STREAM_EDIT_INTERVAL_SECONDS:
+            return
+        await self._show(text)
+
+    async def finish(self, text: str) -> None:
+        if self._sent is None:
+            await self._send(text)
+        else:
+            await self._show(text)
+
+    async def _show(self, text: str) -> None:
+        text = text.strip()
+        if not text or text == self._shown:
+            return
+        if self._sent is None:
+            self._sent = await self._send(text)
+        else:
+            await self._sent.edit_text(text)
+        self._shown = text
+        self._last_update = time.monotonic()
+
+
 class RegistrationStates(StatesGroup):
     display_name = State()
     email = State()
@@ -139,10 +184,19 @@ async def handle_any_message(message: Message, state: FSMContext) -> None:
         return
 
     await state.clear()
-    await asyncio.to_thread(google_service.update_last_seen, message.from_user.id)
+    # Отметка last_seen не влияет на ответ, поэтому пишем её параллельно с обработкой запроса
+    last_seen_task = asyncio.create_task(_update_last_seen_safe(message.from_user.id))
+    try:
+        await _answer_user_request(message, profile)
+    finally:
+        await last_seen_task
+
+
+async def _answer_user_request(message: Message, profile: dict) -> None:
     user_text = message.text or ""
+    reply = _StreamingReply(message.answer)
     try:
-        plan = await ai_service.process_user_request(profile, user_text)
+        plan = await ai_service.process_user_request(profile, user_text, on_chunk=reply.update)
         result = await command_service.execute_plan(profile, plan)
     except Exception as exc:  # noqa: BLE001
         logger.exception("Failed to process incoming message: %s", exc)
@@ -159,7 +213,7 @@ async def handle_any_message(message: Message, state: FSMContext) -> None:
     if not str(reply_text).strip():
         reply_text = "У меня возникла ошибка при ответе. Попробуйте задать вопрос иначе."
     try:
-        await message.answer(reply_text)
+        await reply.finish(reply_text)
     except Exception as exc:  # noqa: BLE001
         logger.warning("Failed to send reply: %s", exc)
 
@@ -172,6 +226,7 @@ async def reminder_worker() -> None:
     while True:
         try:
             users = await asyncio.to_thread(google_service.list_users)
+            pending: list[tuple[int, dict, list[dict]]] = []
             for user in users:
                 try:
                     if str(user.get("notify_telegram", "")).lower() not in {"true", "1", "yes", "y"}:
@@ -184,16 +239,16 @@ async def reminder_worker() -> None:
                     tasks = await asyncio.to_thread(
                         google_service.upcoming_tasks_for_user, user.get("user_id", "")
                     )
-                    if not tasks:
-                        continue
+                    if tasks:
+                        pending.append((chat_id, user, tasks))
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to fetch tasks for reminder, user_id=%s: %s", user.get("user_id"), exc)
 
-                    text = await ai_service.build_reminder_text(tasks, user)
-                    try:
-                        await bot.send_message(chat_id=chat_id, text=text)
-                    except Exception as exc:  # noqa: BLE001
-                        logger.warning(
-                            "Failed to send reminder for user_id=%s: %s", user.get("user_id"), exc
-                        )
+            # Тексты напоминаний для всех пользователей генерируются пакетами, а не вызовом модели на каждого
+            texts = await ai_service.build_reminder_texts([(user, tasks) for _, user, tasks in pending])
+            for (chat_id, user, _), text in zip(pending, texts):
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text)
                 except Exception as exc:  # noqa: BLE001
                     logger.warning("Failed to send reminder for user_id=%s: %s", user.get("user_id"), exc)
         except Exception as exc:  # noqa: BLE001
@@ -207,11 +262,18 @@ def handle_unhandled_exception(loop: asyncio.AbstractEventLoop, context: dict) -
 
 
 async def main() -> None:
-    await asyncio.to_thread(google_service.ensure_structures)
     loop = asyncio.get_running_loop()
+    await asyncio.to_thread(google_service.ensure_structures)
+    await ai_service.load_response_cache()
+    # Соединение с моделью поднимаем заранее, но не задерживаем из-за этого запуск бота
+    warm_up_task = asyncio.create_task(ai_service.warm_up())
     loop.set_exception_handler(handle_unhandled_exception)
     asyncio.create_task(reminder_worker())
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        warm_up_task.cancel()
+        await ai_service.save_response_cache()
 
 
 if __name__ == "__main__":